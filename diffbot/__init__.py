@@ -21,4 +21,4 @@ __version__ = '0.0.2'
 __status__ = 'beta'
 __date__ = '28th March 2011'
 
-from diffbot import DiffBot
+from diffbot import DiffBot, AsyncDiffBot, DiffBotError
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - article.py
+
+    A compact result type for articles, for callers that keep many of them
+    in memory
+
+    Usage:
+
+    >>> db = diffbot.DiffBot(dev_token = "mydevtoken", compact_articles = True)
+    >>> article = db.article("http://www.newssite.com/newsarticle.html")
+    >>> article['title'], len(article['text'])
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+# fields returned by the article API, each given a slot
+FIELDS = (
+    'url',
+    'resolved_url',
+    'icon',
+    'title',
+    'author',
+    'date',
+    'text',
+    'html',
+    'tags',
+    'media',
+    'comments',
+    'stats',
+    'xpath',
+    'numPages',
+    'nextPage',
+    'type',
+    'raw_response',
+)
+
+# fields kept as UTF-8 bytes until they are read
+HEAVY_FIELDS = ('text', 'html')
+
+_SLOTS = dict([(name, '_' + name) for name in FIELDS])
+_HEAVY_SLOTS = frozenset([_SLOTS[name] for name in HEAVY_FIELDS])
+
+_missing = object()
+
+class Article(object):
+    """An article_info as returned by DiffBot.article, with the same
+    dict-style access, that takes less memory than a dict.
+
+    Known fields are kept in slots rather than a per-object dict, and any
+    other fields in a small dict. The heavy fields, text and html, are kept
+    as UTF-8 bytes, which take a quarter of the memory of unicode on a wide
+    build for mostly-ASCII text, and are decoded the first time they are
+    read. Reading them always returns unicode.
+    """
+
+    __slots__ = tuple([_SLOTS[name] for name in FIELDS]) + ('_extra',)
+
+    def __init__(self, article_info = None):
+        self._extra = None
+        if article_info:
+            for key, value in article_info.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        value = getattr(self, slot, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        if slot in _HEAVY_SLOTS and isinstance(value, str):
+            value = value.decode('utf-8')
+            setattr(self, slot, value)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = _SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            return
+        if slot in _HEAVY_SLOTS and isinstance(value, unicode):
+            value = value.encode('utf-8')
+        setattr(self, slot, value)
+
+    def __delitem__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+        elif not hasattr(self, slot):
+            raise KeyError(key)
+        else:
+            delattr(self, slot)
+
+    def __contains__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is None:
+            return self._extra is not None and key in self._extra
+        return hasattr(self, slot)
+
+    has_key = __contains__
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [name for name in FIELDS if hasattr(self, _SLOTS[name])]
+        if self._extra:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        """Returns the article as a plain dict"""
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Article):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Article(%r)' % self.to_dict()
+
+    # slots leave nothing for pickle to find, so state is the undecoded
+    # fields and the extras
+
+    def __getstate__(self):
+        fields = dict([(slot, getattr(self, slot)) for slot in self.__slots__[:-1]
+                       if hasattr(self, slot)])
+        return fields, self._extra
+
+    def __setstate__(self, state):
+        fields, self._extra = state
+        for slot, value in fields.items():
+            setattr(self, slot, value)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - asynchttp.py
+
+    Non-blocking HTTP handler for AsyncDiffBot, built on asyncore. Kept apart
+    from handlers.py so the blocking clients never import asyncore.
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+import logging, time, socket, asyncore, collections
+import urllib, urlparse
+
+from handlers import HttpHandler, AsyncResult
+from cache import handler as cache_handler, AsyncCacheHandler
+from metrics import NULL_METRICS
+
+class _AsyncConnection(asyncore.dispatcher):
+    """A single HTTP/1.0 request/response exchange on the handler's loop"""
+
+    def __init__(self, handler, host, port, request, result):
+        asyncore.dispatcher.__init__(self, map = handler._map)
+        self.handler = handler
+        self.result = result
+        self.started = time.time()
+        self.finished = False
+        self._out = request
+        self._in = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._in.append(data)
+
+    def handle_close(self):
+        self.close()
+        self.handler._finish(self, ''.join(self._in))
+
+    def handle_error(self):
+        logging.exception("async http error")
+        self.close()
+        self.handler._finish(self, None)
+
+
+class AsyncHttpHandler(HttpHandler):
+    """Non-blocking HTTP handler built on an asyncore event loop.
+
+    get and post return an AsyncResult instead of the response body. Requests
+    beyond max_concurrency are queued and started as earlier ones complete.
+    Only plain http URLs are supported.
+
+    Options:
+        max_concurrency:            connections open at once (default 100)
+        timeout:                            seconds before a request is abandoned
+    """
+
+    def __init__(self, cache_options = None, options = None):
+        self.options = options or {}
+        self.metrics = self.options.get('metrics') or NULL_METRICS
+        self.max_concurrency = self.options.get('max_concurrency', 100)
+        self.timeout = self.options.get('timeout', 30)
+        self._map = {}
+        self._queue = collections.deque()
+        self._active = 0
+        self._cache_handle = AsyncCacheHandler(cache_handler(cache_options))
+        if self._cache_handle.cache.metrics is NULL_METRICS:
+            self._cache_handle.set_metrics(self.metrics)
+        self.get = self._cache_handle.wrap(self.get)
+        self.post = self._cache_handle.wrap(self.post)
+
+    def fetch(self, url, data, method):
+        assert method in ['GET', 'POST']
+
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme != 'http':
+            raise ValueError("AsyncHttpHandler only supports http urls: %s" % url)
+        path = parsed.path or '/'
+        headers = dict(self._req_headers)
+        headers['Host'] = parsed.netloc
+        body = ''
+        if method == 'GET':
+            path = path + '?' + urllib.urlencode(data)
+        else:
+            body = urllib.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            headers['Content-Length'] = str(len(body))
+        request = '%s %s HTTP/1.0\r\n' % (method, path)
+        request += ''.join(['%s: %s\r\n' % h for h in headers.items()])
+        request += '\r\n' + body
+
+        result = AsyncResult(self)
+        self._queue.append((parsed.hostname, parsed.port or 80, request, result))
+        self._start()
+        return result
+
+    def _start(self):
+        while self._queue and self._active < self.max_concurrency:
+            host, port, request, result = self._queue.popleft()
+            try:
+                _AsyncConnection(self, host, port, request, result)
+            except socket.error, e:
+                logging.exception("async http error: %s", str(e))
+                result.set_result(False)
+                continue
+            self._active += 1
+
+    def _finish(self, conn, response):
+        if conn.finished:
+            return
+        conn.finished = True
+        self._active -= 1
+        self.metrics.timing('http.request', time.time() - conn.started)
+        self.metrics.gauge('http.in_flight', self._active)
+        body = False
+        if response:
+            head, sep, content = response.partition('\r\n\r\n')
+            status = head.split(' ', 2)[1:2]
+            self.metrics.incr('http.bytes', len(content))
+            if status == ['200']:
+                body = content
+            else:
+                self.metrics.incr('http.errors')
+                logging.error("async http request returned status: %s" % head.split('\r\n')[0])
+        self._start()
+        conn.result.set_result(body)
+
+    def _expire(self):
+        now = time.time()
+        for conn in self._map.values():
+            if now - conn.started > self.timeout:
+                logging.error("async http request timed out after %ss" % self.timeout)
+                conn.close()
+                self._finish(conn, None)
+
+    def pending(self):
+        """Returns the number of requests that are active or queued"""
+        return self._active + len(self._queue)
+
+    def run(self, until = None, timeout = None):
+        """Runs the event loop until no requests are pending, until() returns
+        true or timeout seconds have passed"""
+        deadline = timeout is not None and time.time() + timeout
+        while self.pending():
+            if until is not None and until():
+                break
+            if deadline and time.time() > deadline:
+                break
+            asyncore.loop(timeout = 0.05, count = 1, map = self._map)
+            self._expire()
+
+    def close(self):
+        for conn in self._map.values():
+            conn.close()
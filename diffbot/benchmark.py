@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - benchmark.py
+
+    Local stand-in for the Diffbot API, and a benchmark harness measuring the
+    client against it
+
+    Usage:
+
+    $ python benchmark.py --requests 500 --latency 0.01 --error-rate 0.01 \\
+          --handlers urllib2,pool --caches none,memory --modes serial,threads
+
+    prints one JSON object per scenario with its throughput, p50/p99 latency
+    and memory use.
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+import os, sys, time, random, shutil, tempfile, threading, logging, urlparse, resource
+import BaseHTTPServer, SocketServer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from metrics import percentile
+import pool
+
+#---------------------------------------------------------------------------
+#     Stub Server
+#---------------------------------------------------------------------------
+
+STUB_ARTICLE = '{"url": "http://www.example.com/", "title": "Example", ' \
+               '"text": "Example article text", "xpath": "/HTML[1]/BODY[1]"}'
+
+STUB_FOLLOW_ADD = '<response id="42"><info new="true"><title>Example</title>' \
+                  '<pubDate>Thu, 07 Apr 2011 10:00:00 GMT</pubDate></info></response>'
+
+def stub_article(size):
+    """Returns an article response of roughly size bytes, padding its text"""
+    article = json.loads(STUB_ARTICLE)
+    sentence = 'Example article text. '
+    padding = max(0, size - len(STUB_ARTICLE))
+    article['text'] = (sentence * (padding / len(sentence) + 1))[:padding + len(article['text'])]
+    return json.dumps(article)
+
+def stub_dml(follow_id, items):
+    """Returns a DML archive response for follow_id with the given number of
+    items"""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<dml><channel id="%s">' % follow_id,
+             '<info new="true"><title>Example</title><link>http://www.example.com/</link></info>']
+    for i in xrange(items):
+        parts.append('<item id="%d" hash="h%d"><title>Item %d</title>'
+                     '<link>http://www.example.com/%d</link>'
+                     '<pubDate>Thu, 07 Apr 2011 10:00:00 GMT</pubDate></item>' % (i, i, i, i))
+    parts.append('</channel></dml>')
+    return ''.join(parts)
+
+def load_fixtures(path):
+    """Returns the recorded responses found in the directory path: any of
+    article.json, follow_add.xml and follow_read.xml"""
+    fixtures = {}
+    for name in ('article.json', 'follow_add.xml', 'follow_read.xml'):
+        file_path = os.path.join(path, name)
+        if os.path.exists(file_path):
+            f = open(file_path, 'rb')
+            try:
+                fixtures[name.split('.')[0]] = f.read()
+            finally:
+                f.close()
+    return fixtures
+
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for the Diffbot API. Article requests are answered with
+    STUB_ARTICLE, follow adds with STUB_FOLLOW_ADD and DML archive reads with
+    stub_dml(id, n) items, where n is the number the id starts with. The
+    server's fixtures replace any of these.
+
+    Paths containing 'fail' return a 500, 'flaky' paths return a 503 the
+    first two times they are requested and 'slow' paths take half a second.
+    Every response is delayed by the server's latency, and a share of them
+    given by its error_rate fail with a 503."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    requests = {}
+
+    def do_GET(self):
+        count = self.requests[self.path] = self.requests.get(self.path, 0) + 1
+        if 'fail' in self.path:
+            return self.send_error(500)
+        if 'flaky' in self.path and count <= 2:
+            return self.send_error(503)
+        if 'slow' in self.path:
+            time.sleep(0.5)
+        if self.simulate():
+            return
+        path, sep, query = self.path.partition('?')
+        if path.endswith('/dml/archive'):
+            if self.server.fixtures.has_key('follow_read'):
+                return self.send_body(self.server.fixtures['follow_read'], 'text/xml')
+            follow_id = urlparse.parse_qs(query).get('id', ['0'])[0]
+            items = int(follow_id.partition('-')[0])
+            return self.send_body(stub_dml(follow_id, items), 'text/xml')
+        self.send_body(self.server.fixtures.get('article', STUB_ARTICLE))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        if self.simulate():
+            return
+        if self.path.endswith('/add'):
+            return self.send_body(self.server.fixtures.get('follow_add', STUB_FOLLOW_ADD),
+                                  'text/xml')
+        self.send_body(self.server.fixtures.get('article', STUB_ARTICLE))
+
+    def simulate(self):
+        """Applies the server's latency and error rate. Returns True if an
+        error was sent"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and self.server.random.random() < self.server.error_rate:
+            self.send_error(503)
+            return True
+        return False
+
+    def send_body(self, body, content_type = 'application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    latency = 0
+    error_rate = 0
+
+def start_server(port = 0, latency = 0, error_rate = 0, payload_size = None, fixtures = None,
+                 seed = None):
+    """Starts a stub server on a background thread and returns it. The bound
+    address is available as server.server_address.
+
+    latency is the seconds every response is delayed, error_rate the share
+    of requests answered with a 503 and payload_size the size in bytes of
+    article responses. fixtures is a dict of recorded responses, or a
+    directory to load them from (see load_fixtures)."""
+    server = StubServer(('127.0.0.1', port), StubRequestHandler)
+    server.latency = latency
+    server.error_rate = error_rate
+    server.random = random.Random(seed)
+    if isinstance(fixtures, basestring):
+        fixtures = load_fixtures(fixtures)
+    server.fixtures = dict(fixtures or {})
+    if payload_size and not server.fixtures.has_key('article'):
+        server.fixtures['article'] = stub_article(payload_size)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+#---------------------------------------------------------------------------
+#     Benchmarks
+#---------------------------------------------------------------------------
+
+OPERATIONS = ('article', 'follow_add', 'follow_read')
+HANDLERS = ('urllib', 'urllib2', 'pool')
+CACHES = ('none', 'memory', 'file', 'sqlite')
+MODES = ('serial', 'threads', 'async')
+
+def cache_options(name, folder):
+    """Returns the cache options for the cache named name, storing any files
+    in folder"""
+    if name == 'memory':
+        return {'handler': 'memory'}
+    if name == 'file':
+        return {'handler': 'file', 'cache_folder': folder}
+    if name == 'sqlite':
+        return {'handler': 'sqlite', 'sqlite_path': os.path.join(folder, 'cache.db')}
+    return {}
+
+def call(db, operation, i, distinct, items):
+    """Starts operation on db for the i-th request. Requests cycle through
+    distinct urls (or follow ids), so repeats can be answered by the cache"""
+    key = i % distinct
+    if operation == 'article':
+        return db.article('http://www.example.com/%d' % key)
+    if operation == 'follow_add':
+        return db.follow_add('http://www.example.com/%d' % key)
+    return db.follow_read('%d-%d' % (items, key))
+
+def max_rss():
+    """Returns the peak resident set size of the process in KB"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage / 1024
+    return usage
+
+def run_scenario(url, operation, handler = 'pool', cache = 'none', mode = 'serial',
+                 requests = 200, workers = 8, distinct = None, items = 20):
+    """Runs requests calls of operation against the stub server at url and
+    returns a dict describing the scenario and its results: throughput in
+    requests per second, latency percentiles in milliseconds and memory in
+    KB. mode is serial, threads (a pool of workers threads) or async (an
+    AsyncDiffBot with workers connections); handler is ignored for async.
+
+    The memory figures are the peak resident size of the process and its
+    growth over the scenario, which only describe the scenario if it runs
+    in a process of its own; run_isolated does that."""
+    from diffbot import DiffBot, AsyncDiffBot
+
+    distinct = distinct or requests
+    folder = tempfile.mkdtemp(prefix = 'diffbot-bench-')
+    options = cache_options(cache, folder)
+    rss_before = max_rss()
+    latencies = []
+    errors = [0]
+
+    def timed(i):
+        start = time.time()
+        result = call(db, operation, i, distinct, items)
+        latencies.append(time.time() - start)
+        return result
+
+    try:
+        if mode == 'async':
+            handler = 'async'
+            db = AsyncDiffBot(options, dev_token = 'benchmark',
+                              http_options = {'max_concurrency': workers})
+        else:
+            db = DiffBot(options, dev_token = 'benchmark', attempts = 1,
+                         http_options = {'handler': handler})
+        db.api_endpoint_base = url
+        start = time.time()
+        if mode == 'serial':
+            for i in xrange(requests):
+                if not timed(i):
+                    errors[0] += 1
+        elif mode == 'threads':
+            for i, result, error in pool.imap(timed, xrange(requests), workers, ordered = False):
+                if error is not None or not result:
+                    errors[0] += 1
+        else:
+            def finished(started):
+                def record(result):
+                    latencies.append(time.time() - started)
+                    if not result:
+                        errors[0] += 1
+                return record
+            for i in xrange(requests):
+                call(db, operation, i, distinct, items).add_callback(finished(time.time()))
+            db.run()
+        elapsed = time.time() - start
+        db.http_handler().close()
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+
+    latencies.sort()
+    return {
+        'operation': operation,
+        'handler': handler,
+        'cache': cache,
+        'mode': mode,
+        'requests': requests,
+        'errors': errors[0],
+        'seconds': round(elapsed, 4),
+        'throughput': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_rss_kb': max_rss(),
+        'rss_growth_kb': max_rss() - rss_before,
+    }
+
+SCENARIO_SCRIPT = """
+import sys, json
+from benchmark import run_scenario
+print json.dumps(run_scenario(*json.loads(sys.argv[1])))
+"""
+
+def run_isolated(url, operation, handler = 'pool', cache = 'none', mode = 'serial',
+                 requests = 200, workers = 8, distinct = None, items = 20):
+    """Returns run_scenario for the arguments, run in a fresh interpreter so
+    its memory figures are not affected by earlier scenarios"""
+    import subprocess
+
+    args = json.dumps([url, operation, handler, cache, mode, requests, workers, distinct,
+                       items])
+    process = subprocess.Popen([sys.executable, '-c', SCENARIO_SCRIPT, args],
+                               cwd = os.path.dirname(os.path.abspath(__file__)),
+                               stdout = subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise Exception("Scenario %s failed with exit status %d"
+                        % (' '.join(map(str, (operation, handler, cache, mode))),
+                           process.returncode))
+    return json.loads(output)
+
+def scenarios(operations = OPERATIONS, handlers = HANDLERS, caches = CACHES, modes = MODES):
+    """Yields the (operation, handler, cache, mode) combinations to run. The
+    async mode has its own handler, so it is run once per operation and
+    cache."""
+    for operation in operations:
+        for cache in caches:
+            for mode in modes:
+                for handler in (mode == 'async' and handlers[:1] or handlers):
+                    yield operation, handler, cache, mode
+
+STARTUP_SCRIPT = """
+import time
+start = time.time()
+import diffbot
+imported = time.time()
+diffbot.DiffBot(dev_token = 'benchmark')
+print (imported - start) * 1000, (time.time() - imported) * 1000
+"""
+
+def startup(runs = 10):
+    """Returns the median and fastest times in milliseconds, over runs fresh
+    interpreters, to import the package and to create the first client"""
+    import subprocess
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    imports, clients = [], []
+    for i in xrange(runs):
+        output = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT], cwd = root,
+                                  stdout = subprocess.PIPE).communicate()[0]
+        import_ms, client_ms = map(float, output.split())
+        imports.append(import_ms)
+        clients.append(client_ms)
+    imports.sort()
+    clients.sort()
+    return {
+        'benchmark': 'startup',
+        'runs': runs,
+        'import_p50_ms': round(percentile(imports, 50), 3),
+        'import_min_ms': round(imports[0], 3),
+        'first_client_p50_ms': round(percentile(clients, 50), 3),
+        'first_client_min_ms': round(clients[0], 3),
+    }
+
+ARTICLE_MEMORY_SCRIPT = """
+import sys
+from benchmark import stub_article, max_rss
+from diffbot import parse_article
+from article import Article
+count, size, compact = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3] == 'compact'
+response = stub_article(size)
+articles = []
+before = max_rss()
+for i in xrange(count):
+    article_info = parse_article(response)
+    articles.append(compact and Article(article_info) or article_info)
+print max_rss() - before
+"""
+
+def article_memory(count = 20000, size = 1000):
+    """Returns the memory held by count article results decoded from
+    responses of size bytes, kept as dicts and as article.Article objects,
+    scaled to KB per 100k articles. Each is measured in a fresh
+    interpreter."""
+    import subprocess
+
+    def measure(kind):
+        output = subprocess.Popen([sys.executable, '-c', ARTICLE_MEMORY_SCRIPT,
+                                   str(count), str(size), kind],
+                                  cwd = os.path.dirname(os.path.abspath(__file__)),
+                                  stdout = subprocess.PIPE).communicate()[0]
+        return int(output) * 100000 / count
+
+    dict_kb, article_kb = measure('dict'), measure('compact')
+    return {
+        'benchmark': 'article_memory',
+        'count': count,
+        'payload_size': size,
+        'dict_kb_per_100k': dict_kb,
+        'article_kb_per_100k': article_kb,
+        'saved_kb_per_100k': dict_kb - article_kb,
+    }
+
+def main(argv = None):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = "%prog: [options]")
+    parser.add_option('-n', '--requests', type = 'int', default = 200,
+                      help = "requests per scenario (default 200)")
+    parser.add_option('-w', '--workers', type = 'int', default = 8,
+                      help = "threads or async connections (default 8)")
+    parser.add_option('--distinct', type = 'int',
+                      help = "distinct urls per scenario (default --requests)")
+    parser.add_option('--items', type = 'int', default = 20,
+                      help = "items in each follow_read response (default 20)")
+    parser.add_option('--latency', type = 'float', default = 0,
+                      help = "seconds the server delays each response")
+    parser.add_option('--error-rate', type = 'float', default = 0, dest = 'error_rate',
+                      help = "share of requests answered with a 503")
+    parser.add_option('--payload-size', type = 'int', dest = 'payload_size',
+                      help = "bytes in each article response")
+    parser.add_option('--fixtures', help = "directory of recorded responses")
+    parser.add_option('--operations', default = ','.join(OPERATIONS))
+    parser.add_option('--handlers', default = ','.join(HANDLERS))
+    parser.add_option('--caches', default = ','.join(CACHES))
+    parser.add_option('--modes', default = ','.join(MODES))
+    parser.add_option('-o', '--output', help = "file to write results to (default stdout)")
+    parser.add_option('--startup', action = 'store_true',
+                      help = "only measure import and first client creation times")
+    parser.add_option('--article-memory', type = 'int', dest = 'article_memory',
+                      metavar = 'COUNT',
+                      help = "only measure the memory held by COUNT article results")
+    (options, args) = parser.parse_args(argv)
+
+    if options.startup:
+        print json.dumps(startup(), sort_keys = True)
+        return
+    if options.article_memory:
+        print json.dumps(article_memory(options.article_memory, options.payload_size or 1000),
+                         sort_keys = True)
+        return
+
+    logging.basicConfig(level = logging.CRITICAL)
+    server = start_server(latency = options.latency, error_rate = options.error_rate,
+                          payload_size = options.payload_size, fixtures = options.fixtures,
+                          seed = 0)
+    url = 'http://%s:%d/api/' % server.server_address
+    out = options.output and open(options.output, 'w') or sys.stdout
+    try:
+        for operation, handler, cache, mode in scenarios(
+                options.operations.split(','), options.handlers.split(','),
+                options.caches.split(','), options.modes.split(',')):
+            result = run_isolated(url, operation, handler, cache, mode, options.requests,
+                                  options.workers, options.distinct, options.items)
+            out.write(json.dumps(result, sort_keys = True) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,8 @@
 """
     py-diffbot - cache.py
 
-    Caching handlers with support for file, GAE memcache and python memcache
+    Caching handlers with support for file, SQLite, GAE memcache, python
+    memcache and an in-process memory tier
 
     This source file is subject to the new BSD license that is bundled with this
     package in the file LICENSE.txt. The license is also available online at the
@@ -18,127 +19,1321 @@ __version__ = '0.0.2'
 __author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
 
 
-import os, logging, hashlib, urllib
+import os, re, time, atexit, logging, hashlib, threading, collections
+import weakref
+
+from metrics import NULL_METRICS
+import compat
+
+#---------------------------------------------------------------------------
+#     Cache Keys
+#---------------------------------------------------------------------------
+
+# request parameters left out of cache keys
+KEY_EXCLUDE = ('token',)
+
+# query parameters stripped from urls in cache keys. Names ending in * match
+# every parameter starting with the rest of the name.
+TRACKING_PARAMS = (
+    'utm_*',
+    'fbclid',
+    'gclid',
+    'dclid',
+    'msclkid',
+    'mc_cid',
+    'mc_eid',
+    '_ga',
+    '_hsenc',
+    '_hsmi',
+    'ref_src',
+)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def canonical_url(url, strip_params = TRACKING_PARAMS):
+    """Returns url with its scheme and host lowercased, the default port,
+    fragment, dot segments, repeated and trailing slashes removed, the query
+    parameters named in strip_params removed and the rest sorted by name.
+    Repeated parameters keep their order, and fragments starting with !
+    (hashbang routes) are kept, since both can select a different page. Urls
+    that are not absolute http(s) urls are returned unchanged."""
+    import urllib, urlparse, posixpath
 
-try:
-    from google.appengine.api import memcache
-    GAE = True
-except ImportError:
-    GAE = False
     try:
-        import memcache
-        LOCAL_MEMCACHE = True
-    except ImportError:
-        LOCAL_MEMCACHE = False
+        parts = urlparse.urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return url
+    if not DEFAULT_PORTS.has_key(scheme) or not host:
+        return url
+    if ':' in host:
+        host = '[%s]' % host
+    if port and port != DEFAULT_PORTS[scheme]:
+        host = '%s:%d' % (host, port)
+    path = parts.path
+    if path.strip('/'):
+        path = '/' + posixpath.normpath(path).strip('/')
+    else:
+        path = '/'
+    query = parts.query
+    if query:
+        prefixes = tuple([name[:-1] for name in strip_params if name.endswith('*')])
+        params = [(name, value) for name, value
+                  in urlparse.parse_qsl(query, keep_blank_values = True)
+                  if name not in strip_params and not (prefixes and name.startswith(prefixes))]
+        params.sort(key = _param_name)
+        query = urllib.urlencode(params)
+    fragment = parts.fragment
+    if not fragment.startswith('!'):
+        fragment = ''
+    return urlparse.urlunsplit((scheme, host, path, query, fragment))
+
+def _param_name(param):
+    return param[0]
+
+def key_report(requests, cache_options = None):
+    """Returns a dict with the count of requests, an iterable of (url, data)
+    pairs, and of the distinct raw and canonical keys among them, so
+    duplicate_requests is the number of upstream calls canonical keys save
+    on a cold cache"""
+    import urllib
+
+    cache = NullHandler(cache_options)
+    count = 0
+    raw, canonical = set(), set()
+    for url, data in requests:
+        count += 1
+        raw.add(url + '?' + urllib.urlencode(data))
+        canonical.add(cache.canonical(url, data))
+    return {
+        'requests': count,
+        'raw_keys': len(raw),
+        'canonical_keys': len(canonical),
+        'duplicate_requests': len(raw) - len(canonical),
+    }
 
 #---------------------------------------------------------------------------
 #     Handler Classes
 #---------------------------------------------------------------------------
 
+# marks entries stored with the time they were fetched
+STAMP = '\x00t'
+
+# compression modules by name, with the marker their entries start with.
+# A module is only imported once an entry is compressed or decompressed with it.
+CODECS = {
+    'zlib': '\x00z',
+    'bz2': '\x00b',
+}
+
 class CacheHandler(object):
+    """Base class for cache handlers.
+
+    Handlers that store values outside the process pass them through encode
+    and decode, which compress values of at least cache_compress_threshold
+    bytes with the cache_compress codec. Compressed values carry a two byte
+    marker, so entries written without compression are still readable.
+
+    With cache_parsed set, callers that pass a parse function to the wrapped
+    fetch function get back the parsed object, and that object is cached
+    (as a marshal dump outside the process) so hits skip parsing.
+
+    With cache_soft_ttl set, entries older than that are still served by
+    wrap but refreshed on a background thread (stale-while-revalidate);
+    entries older than cache_hard_ttl are refetched before returning. With
+    cache_negative_ttl set, failed fetches are remembered for that many
+    seconds and answered with False instead of being retried upstream.
+    Either option makes wrap store the time alongside each entry; entries
+    written without it count as fresh.
+
+    Keys are built from a canonical form of the request (see canonical):
+    parameters are sorted, credentials are left out, and the endpoint and
+    the url of the article requested have their scheme, host and path
+    normalized and tracking parameters removed. stats() reports the
+    lookups, lookup_hits and hit_ratio of wrap and lookup; key_report
+    measures the requests canonical keys deduplicate.
+
+    Options:
+        cache_compress:             zlib, bz2 or None (default None)
+        cache_compress_level:       compression level, 1-9 (default 6)
+        cache_compress_threshold:   smallest value compressed (default 1024)
+        cache_parsed:               cache parsed responses (default False)
+        cache_soft_ttl:             seconds before an entry is refreshed in
+                                    the background (default never)
+        cache_hard_ttl:             seconds before an entry is no longer
+                                    served (default never)
+        cache_negative_ttl:         seconds a failed fetch is remembered
+                                    (default 0, not at all)
+        cache_canonical_keys:       build keys from the canonical request
+                                    (default True)
+        cache_key_exclude:          parameters left out of keys (default
+                                    KEY_EXCLUDE, the credentials)
+        cache_strip_params:         query parameters removed from urls in
+                                    keys; names ending in * match a prefix
+                                    (default TRACKING_PARAMS)
+        metrics:                    metrics.Metrics receiving cache metrics
+                                    (default the http handler's)
+    """
 
     options = None
+    codec = None
+    compress_level = 6
+    compress_threshold = 1024
+    cache_parsed = False
+    soft_ttl = None
+    hard_ttl = None
+    negative_ttl = 0
+    canonical_keys = True
+    key_exclude = KEY_EXCLUDE
+    strip_params = TRACKING_PARAMS
+    # request parameters holding a url, canonicalized like the endpoint
+    url_params = ('url',)
 
     def __init__(self, options):
         self.options = options
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.metrics = options and options.get('metrics') or NULL_METRICS
+        if options:
+            self.codec = options.get('cache_compress', self.codec)
+            if self.codec is not None and not CODECS.has_key(self.codec):
+                raise Exception("Unknown cache codec: %s" % self.codec)
+            self.compress_level = options.get('cache_compress_level', self.compress_level)
+            self.compress_threshold = options.get('cache_compress_threshold',
+                                                  self.compress_threshold)
+            self.cache_parsed = options.get('cache_parsed', self.cache_parsed)
+            self.soft_ttl = options.get('cache_soft_ttl', self.soft_ttl)
+            self.hard_ttl = options.get('cache_hard_ttl', self.hard_ttl)
+            self.negative_ttl = options.get('cache_negative_ttl', self.negative_ttl)
+            self.canonical_keys = options.get('cache_canonical_keys', self.canonical_keys)
+            self.key_exclude = options.get('cache_key_exclude', self.key_exclude)
+            self.strip_params = options.get('cache_strip_params', self.strip_params)
+        self._stamped = bool(self.soft_ttl or self.hard_ttl or self.negative_ttl)
+        self._refreshing = set()
+
+    def encode(self, value):
+        """Returns value as it should be stored"""
+        stored = value
+        if self.codec is not None and len(value) >= self.compress_threshold:
+            codec = compat.module(self.codec)
+            compressed = CODECS[self.codec] + codec.compress(value, self.compress_level)
+            if len(compressed) < len(value):
+                stored = compressed
+        self._count('bytes_in', len(value))
+        self._count('bytes_stored', len(stored))
+        return stored
+
+    def decode(self, stored):
+        """Returns the value for a stored entry written by encode"""
+        if stored and stored[0] == '\x00':
+            for name, marker in CODECS.items():
+                if stored.startswith(marker):
+                    return compat.module(name).decompress(stored[len(marker):])
+        return stored
 
     def wrap(self, func):
-        def cache(url, data):
-            logging.info("Called fetch function with")
-            key = self.hash(url + '?' + urllib.urlencode(data))
-            cache_store = self.get(key)
-            if cache_store:
-                return cache_store
-            val = func(url, data)
-            if val:
-                self.set(key, val)
+        """Wraps a fetch function with the cache. Concurrent misses for the
+        same key share a single call to func.
+
+        The wrapped function takes an optional parse function, which is
+        applied to the response before it is returned (see cache_parsed),
+        and an optional load function that parses the response from a
+        file-like object. load is passed on to func when parsed responses
+        are cached, so they can be streamed."""
+        def call(parsed, url, data, parse, load):
+            if parsed:
+                return func(url, data, parse, load)
+            return func(url, data)
+        def fetch(key, parsed, url, data, parse, load):
+            val = call(parsed, url, data, parse, load)
+            self._store_entry(key, val, parsed)
             return val
+        def cache(url, data, parse = None, load = None):
+            logging.info("Called fetch function with")
+            key, parsed, state, val = self._entry(url, data, parse)
+            if state == 'negative':
+                self._count('negative_hits')
+                return False
+            if state in ('fresh', 'stale'):
+                if state == 'stale':
+                    self._refresh(key, call, parsed, url, data, parse, load)
+                return self._result(val, parsed, parse)
+            val, shared = self._flight.do(key, fetch, key, parsed, url, data, parse, load)
+            if shared:
+                self._count('coalesced')
+            if not val:
+                return val
+            return self._result(val, parsed, parse)
         return cache
 
+    def lookup(self, url, data, parse = None):
+        """Returns the fresh cached response for a request, passed through
+        parse if given, or None if it is not cached. Only hits count towards
+        the lookup stats and metrics, since anything else is normally
+        fetched through wrap, which counts it."""
+        key, parsed, state, val = self._entry(url, data, parse, probe = True)
+        if state != 'fresh':
+            return None
+        return self._result(val, parsed, parse)
+
+    def fresh(self, url, data, parse = None):
+        """Returns True if a request would be answered from the cache without
+        a refresh. parse is as for lookup."""
+        key = self.key(url, data)
+        parsed = parse is not None and self.cache_parsed
+        if parsed:
+            key = self.parsed_key(key)
+        return self._state(self._load_entry(key, parsed)) == 'fresh'
+
+    def _entry(self, url, data, parse, probe = False):
+        """Returns (key, parsed, state, value) for the entry a request would
+        be answered with. state is one of the _state values. A probe only
+        counts fresh entries, as hits."""
+        metrics = self.metrics
+        start = metrics.sinks and time.time()
+        key = self.key(url, data)
+        parsed = parse is not None and self.cache_parsed
+        if parsed:
+            key = self.parsed_key(key)
+        entry = self._load_entry(key, parsed)
+        state = self._state(entry)
+        hit = state in ('fresh', 'stale')
+        if probe and state != 'fresh':
+            return key, parsed, state, entry and entry[1]
+        self._count_lookup(hit)
+        if start:
+            metrics.timing('cache.lookup', time.time() - start)
+            metrics.incr(hit and 'cache.hit' or 'cache.miss')
+        return key, parsed, state, entry and entry[1]
+
+    def _result(self, val, parsed, parse):
+        if parsed:
+            import copy
+
+            return copy.deepcopy(val)
+        if parse is not None:
+            return self.metrics.timed('parse.' + parse.__name__, parse, val)
+        return val
+
+    def _load_entry(self, key, parsed = False):
+        """Returns the (stored_at, value) pair wrap stored under key, or None.
+        stored_at is None for entries stored without a time, and value is
+        None for a negative entry."""
+        if parsed:
+            stored = self.get_object(key)
+            if stored is None:
+                return None
+            if self._stamped and isinstance(stored, tuple) and len(stored) == 3 \
+                    and stored[0] == STAMP:
+                return stored[1], stored[2]
+            return None, stored
+        stored = self.get(key)
+        if not stored:
+            return None
+        if self._stamped and stored.startswith(STAMP):
+            stored_at, sep, value = stored[len(STAMP):].partition('\x00')
+            return float(stored_at), value or None
+        return None, stored
+
+    def _store_entry(self, key, val, parsed = False):
+        """Stores the result of a fetch under key. Failures are stored as a
+        negative entry if negative_ttl is set."""
+        if not val and not self.negative_ttl:
+            return
+        if not val:
+            val = None
+        if parsed:
+            if self._stamped:
+                val = (STAMP, time.time(), val)
+            if val is not None:
+                self.set_object(key, val)
+        else:
+            if self._stamped:
+                val = '%s%.3f\x00%s' % (STAMP, time.time(), val or '')
+            if val is not None:
+                self.set(key, val)
+
+    def _state(self, entry):
+        """Returns 'miss', 'fresh', 'stale' (past the soft ttl) or 'negative'
+        for an entry returned by _load_entry"""
+        if entry is None:
+            return 'miss'
+        stored_at, val = entry
+        if stored_at is None:
+            return val is None and 'miss' or 'fresh'
+        age = time.time() - stored_at
+        if val is None:
+            return age < self.negative_ttl and 'negative' or 'miss'
+        if self.hard_ttl and age >= self.hard_ttl:
+            return 'miss'
+        if self.soft_ttl and age >= self.soft_ttl:
+            return 'stale'
+        return 'fresh'
+
+    def _refresh(self, key, call, parsed, *args):
+        """Runs call(parsed, *args) on a background thread, unless a refresh
+        of key is already running, and stores the result under key. A failed
+        refresh leaves the stale entry in place."""
+        self._stats_lock.acquire()
+        try:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        finally:
+            self._stats_lock.release()
+        self._count('stale')
+
+        def refresh():
+            try:
+                val = call(parsed, *args)
+                if val:
+                    self._store_entry(key, val, parsed)
+                    self._count('refreshed')
+            except Exception, e:
+                logging.exception(e)
+            finally:
+                self._stats_lock.acquire()
+                self._refreshing.discard(key)
+                self._stats_lock.release()
+        thread = threading.Thread(target = refresh)
+        thread.daemon = True
+        thread.start()
+
+    def key(self, url, data):
+        """Returns the cache key used by wrap for a request"""
+        return self.hash(self.canonical(url, data))
+
+    def canonical(self, url, data):
+        """Returns the canonical form of a request that its key is a hash
+        of. Requests for the same resource that differ only in parameter
+        order, credentials, tracking parameters, fragments other than
+        hashbang routes, host case, default ports or trailing slashes have
+        the same canonical form."""
+        import urllib
+
+        if not self.canonical_keys:
+            return url + '?' + urllib.urlencode(data)
+        if hasattr(data, 'items'):
+            data = data.items()
+        params = []
+        for name, value in data:
+            if name in self.key_exclude:
+                continue
+            if name in self.url_params and isinstance(value, basestring):
+                value = canonical_url(value, self.strip_params)
+            params.append((name, value))
+        params.sort(key = _param_name)
+        return canonical_url(url, ()) + '?' + urllib.urlencode(params)
+
+    def parsed_key(self, key):
+        """Returns the key the parsed response for key is cached under"""
+        return self.hash(key + ':parsed')
+
+    def get_object(self, key):
+        """Returns the object stored with set_object, or None"""
+        import marshal
+
+        val = self.get(key)
+        if not val:
+            return None
+        try:
+            return marshal.loads(val)
+        except (ValueError, EOFError, TypeError):
+            return None
+
+    def set_object(self, key, obj):
+        import marshal
+
+        return self.set(key, marshal.dumps(obj, 2))
+
     def hash(self, key):
         return hashlib.sha1(key).hexdigest()
 
+    def get_multi(self, keys):
+        """Returns a dict of the values found for keys"""
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value:
+                values[key] = value
+        return values
+
+    def set_multi(self, mapping):
+        """Stores every key and value in mapping. Returns the keys that could
+        not be stored"""
+        return [key for key, value in mapping.items() if not self.set(key, value)]
+
+    def set_metrics(self, metrics):
+        """Sends this handler's metrics to metrics"""
+        self.metrics = metrics
+
+    def _count(self, name, value = 1):
+        self.metrics.incr('cache.' + name, value)
+        self._stats_lock.acquire()
+        try:
+            self._stats[name] = self._stats.get(name, 0) + value
+        finally:
+            self._stats_lock.release()
+
+    def _count_lookup(self, hit):
+        self._count('lookups')
+        if hit:
+            self._count('lookup_hits')
+
+    def stats(self):
+        """Returns a dict of counters collected by the handler, along with the
+        compression_ratio of values written through encode and the hit_ratio
+        of lookups"""
+        self._stats_lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._stats_lock.release()
+        if stats.get('bytes_stored'):
+            stats['compression_ratio'] = float(stats['bytes_in']) / stats['bytes_stored']
+        if stats.get('lookups'):
+            stats['hit_ratio'] = float(stats.get('lookup_hits', 0)) / stats['lookups']
+        return stats
+
+class SingleFlight(object):
+    """Collapses concurrent calls for the same key into one call, whose result
+    (or exception) is shared by every caller waiting on it."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """Calls func(*args) unless a call for key is already in flight, in
+        which case that call's result is waited for. Returns a (result,
+        shared) tuple."""
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args)
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.event.set()
+        return call.result, False
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
 class NullHandler(CacheHandler):
+    """Handler that caches nothing, but still coalesces concurrent identical
+    requests. Since nothing is stored it always takes the parsed path, so
+    responses can be streamed."""
+
     def __init__(self, options):
-        pass
+        CacheHandler.__init__(self, options)
+        self.cache_parsed = True
+
+    def get(self, key):
+        return False
+
+    def set(self, key, value):
+        return True
+
+    def set_object(self, key, obj):
+        return True
+
+class AsyncCacheHandler(CacheHandler):
+    """Adapts a cache handler to functions returning a handlers.AsyncResult.
+
+    Lookups run inline before the request is issued, so a hit is returned as
+    an already completed result; responses are stored once the request
+    completes. Entries past the wrapped handler's soft ttl are returned and
+    refreshed by a request on the same loop, and remembered failures are
+    answered with False, as by CacheHandler.wrap.
+    """
+
+    def __init__(self, cache):
+        CacheHandler.__init__(self, None)
+        self.cache = cache
+        self._inflight = {}
+
+    def key(self, url, data):
+        return self.cache.key(url, data)
+
+    def get(self, key):
+        entry = self.cache._load_entry(key)
+        if self.cache._state(entry) in ('fresh', 'stale'):
+            return entry[1]
+        return None
+
+    def set(self, key, value):
+        """Stores value under key, or a negative entry if value is a failure
+        and negative_ttl is set"""
+        return self.cache._store_entry(key, value)
+
+    def set_metrics(self, metrics):
+        CacheHandler.set_metrics(self, metrics)
+        self.cache.set_metrics(metrics)
 
     def wrap(self, func):
-        return func
+        from handlers import AsyncResult
+
+        def completed(val):
+            result = AsyncResult()
+            result.set_result(val)
+            return result
+
+        def cache(url, data):
+            key = self.key(url, data)
+            entry = self.cache._load_entry(key)
+            state = self.cache._state(entry)
+            self._count_lookup(state in ('fresh', 'stale'))
+            self.metrics.incr(state in ('fresh', 'stale') and 'cache.hit' or 'cache.miss')
+            if state == 'negative':
+                self._count('negative_hits')
+                return completed(False)
+            if state in ('fresh', 'stale'):
+                if state == 'stale':
+                    self._refresh_async(key, func, url, data)
+                return completed(entry[1])
+            if self._inflight.has_key(key):
+                self._count('coalesced')
+                return self._inflight[key].then(lambda val: val)
+            def store(val):
+                del self._inflight[key]
+                self.set(key, val)
+            result = self._inflight[key] = func(url, data)
+            result.add_callback(store)
+            return result
+        return cache
+
+    def _refresh_async(self, key, func, url, data):
+        """Issues a request refreshing the stale entry for key, unless one is
+        already in flight. A failed refresh leaves the stale entry in place."""
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        self._count('stale')
+
+        def refreshed(val):
+            self._refreshing.discard(key)
+            if val:
+                self.set(key, val)
+                self._count('refreshed')
+        func(url, data).add_callback(refreshed)
 
 class MemcacheHandler(CacheHandler):
+    """Cache handler for memcached using python-memcached, or pymemcache if
+    that is installed instead. One client is created per handler and reused
+    for every request.
+
+    Options:
+        memcache_server:        "host:port", or a list of them
+        memcache_ttl:           seconds entries are kept (default 4 days)
+        memcache_prefix:        prefix added to every key
+        memcache_client:        client object to use instead of connecting
+    """
+    ttl = 60 * 60 * 24 * 4
+
+    def __init__(self, options):
+        CacheHandler.__init__(self, options)
+        options = options or {}
+        self.ttl = options.get('memcache_ttl', self.ttl)
+        self.prefix = options.get('memcache_prefix', '')
+        if options.has_key('memcache_client'):
+            self.client = options['memcache_client']
+        else:
+            self.client = self._connect(options.get('memcache_server', '127.0.0.1:11211'))
+
+    def _connect(self, servers):
+        if isinstance(servers, basestring):
+            servers = servers.split(',')
+        servers = [server.strip() for server in servers]
+        client = compat.memcache_client()
+        if client == 'memcache':
+            return compat.module('memcache').Client(servers)
+        if client is None:
+            raise Exception("MemcacheHandler needs python-memcached or pymemcache")
+        from pymemcache.client.base import PooledClient
+        from pymemcache.client.hash import HashClient
+
+        addresses = []
+        for server in servers:
+            host, sep, port = server.partition(':')
+            addresses.append((host, int(port or 11211)))
+        if len(addresses) == 1:
+            return PooledClient(addresses[0])
+        return HashClient(addresses, use_pooling = True)
 
-    def fname(self):
-        pass
+    def get(self, key):
+        return self.decode(self.client.get(self.prefix + key)) or False
+
+    def set(self, key, value):
+        return bool(self.client.set(self.prefix + key, self.encode(value), self.ttl))
 
-    def fname(self):
-        pass
+    def get_multi(self, keys):
+        if hasattr(self.client, 'get_multi'):
+            values = self.client.get_multi(keys, key_prefix = self.prefix)
+        else:
+            values = self.client.get_many([self.prefix + key for key in keys])
+            values = dict([(key[len(self.prefix):], value) for key, value in values.items()])
+        return dict([(key, self.decode(value)) for key, value in values.items()])
+
+    def set_multi(self, mapping):
+        mapping = dict([(key, self.encode(value)) for key, value in mapping.items()])
+        if hasattr(self.client, 'set_multi'):
+            return self.client.set_multi(mapping, self.ttl, key_prefix = self.prefix)
+        failed = self.client.set_many(dict([(self.prefix + key, value)
+            for key, value in mapping.items()]), self.ttl)
+        return [key[len(self.prefix):] for key in failed or []]
 
 
 class GAEMemcacheHandler(CacheHandler):
     ttl = 60 * 60 * 24 * 4
 
+    def __init__(self, options):
+        CacheHandler.__init__(self, options)
+        from google.appengine.api import memcache
+
+        self.memcache = memcache
+
     def get(self, key):
-        return memcache.get(key)
+        return self.decode(self.memcache.get(key))
 
     def set(self, key, value):
-        return memcache.set(key, value, self.ttl)
+        return self.memcache.set(key, self.encode(value), self.ttl)
+
+    def get_multi(self, keys):
+        values = self.memcache.get_multi(keys)
+        return dict([(key, self.decode(value)) for key, value in values.items()])
+
+    def set_multi(self, mapping):
+        mapping = dict([(key, self.encode(value)) for key, value in mapping.items()])
+        return self.memcache.set_multi(mapping, self.ttl)
 
 
 class FileCacheHandler(CacheHandler):
+    """Cache handler storing one file per entry under cache_folder.
+
+    Entries are fanned out into shard subdirectories and written to a
+    temporary file that is then renamed into place, so readers never see a
+    partial entry. Entries older than cache_ttl (by mtime) are treated as
+    misses. A garbage collector runs in the background to remove expired
+    entries, at most every cache_gc_interval seconds, and the oldest entries
+    beyond cache_max_size. The size of the cache is tracked as entries are
+    written, so with only cache_max_size set the folder is scanned once at
+    start and then only when the cache grows past it; each pass shrinks the
+    cache to gc_low_water of cache_max_size, so passes are spread out.
+
+    Options:
+        cache_folder:           folder for cache files (default tmp)
+        cache_shard_depth:      levels of two character subdirectories (default 2)
+        cache_ttl:              seconds entries are valid (default forever)
+        cache_max_size:         total bytes kept on disk (default unbounded)
+        cache_gc_interval:      seconds between collections of expired entries
+                                (default 300)
+    """
 
     cache_folder = None
+    shard_depth = 2
+    ttl = None
+    max_size = None
+    gc_interval = 300
+    gc_low_water = 0.9
+
+    _entry_re = re.compile(r'^[0-9a-f]{40}\.txt$')
 
     def __init__(self, options):
+        CacheHandler.__init__(self, options)
         if options is not None and options.has_key('cache_folder'):
             cf = options['cache_folder']
             if not cf.startswith('/'):
                 cf = os.path.join(os.path.dirname(__file__), cf)
             if os.path.isdir(cf):
-                self.cache_folder = options['cache_folder']
+                self.cache_folder = cf
             else:
                 raise Exception("Not a valid cache folder: %s (got: %s)" % (cf, os.path.isdir(cf)))
         else:
             import tempfile
+
             self.cache_folder = tempfile.gettempdir()
+        options = options or {}
+        self.shard_depth = options.get('cache_shard_depth', self.shard_depth)
+        self.ttl = options.get('cache_ttl', self.ttl)
+        self.max_size = options.get('cache_max_size', self.max_size)
+        self.gc_interval = options.get('cache_gc_interval', self.gc_interval)
+        # bytes on disk as of the last collection plus those written since;
+        # None until the first collection
+        self._size = None
+        self._written_during_gc = 0
+        self._last_gc = time.time()
+        self._gc_running = False
+        self._gc_lock = threading.Lock()
 
     def get_filepath(self, key):
-        return os.path.join(self.cache_folder, "%s.txt" % key)
+        shard = self.hash(key)
+        parts = [shard[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.cache_folder, *(parts + ["%s.txt" % key]))
 
     def get(self, key):
         file_path = self.get_filepath(key)
-        if os.path.isfile(file_path):
-            logging.info("CACHE HIT")
-            return open(file_path).read()
-        return False
+        try:
+            mtime = os.stat(file_path).st_mtime
+        except OSError:
+            return False
+        if self.ttl is not None and mtime + self.ttl < time.time():
+            self._remove(file_path)
+            self._count('expired')
+            return False
+        try:
+            f = open(file_path, 'rb')
+            try:
+                value = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return False
+        logging.info("CACHE HIT")
+        return self.decode(value)
 
     def set(self, key, value):
         file_path = self.get_filepath(key)
+        folder = os.path.dirname(file_path)
         try:
-            f = open(file_path, 'w')
-            f.write(value)
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    if not os.path.isdir(folder):
+                        raise
+            import tempfile
+
+            fd, tmp_path = tempfile.mkstemp(dir = folder, prefix = '.tmp')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    stored = self.encode(value)
+                    f.write(stored)
+                finally:
+                    f.close()
+                os.rename(tmp_path, file_path)
+            except Exception:
+                self._remove(tmp_path)
+                raise
         except Exception, e:
             logging.error("Exception: could not write file %s" % (file_path))
             logging.exception(e)
             return False
+        self._written(len(stored))
         return True
 
+    def _remove(self, file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+    def _written(self, size):
+        if self.ttl is None and self.max_size is None:
+            return
+        self._gc_lock.acquire()
+        try:
+            if self._size is not None:
+                self._size += size
+            if self._gc_running:
+                self._written_during_gc += size
+                return
+            if not self._gc_due():
+                return
+            self._gc_running = True
+            self._written_during_gc = 0
+        finally:
+            self._gc_lock.release()
+        thread = threading.Thread(target = self._run_gc)
+        thread.daemon = True
+        thread.start()
+
+    def _gc_due(self):
+        if self.max_size is not None and (self._size is None or self._size > self.max_size):
+            return True
+        return self.ttl is not None and time.time() - self._last_gc >= self.gc_interval
+
+    def _run_gc(self):
+        while True:
+            try:
+                self.collect()
+            except Exception, e:
+                logging.exception(e)
+            self._gc_lock.acquire()
+            try:
+                # entries written while the folder was scanned may be missing
+                # from its total
+                if self._size is not None:
+                    self._size += self._written_during_gc
+                self._written_during_gc = 0
+                if self.max_size is None or self._size is None or self._size <= self.max_size:
+                    self._gc_running = False
+                    return
+            finally:
+                self._gc_lock.release()
+
+    def _entries(self):
+        """Yields (path, size, mtime) for every cache entry on disk. Only shard
+        directories and sha1 named files are considered, since the default
+        cache folder is shared with other programs."""
+        folders = [self.cache_folder]
+        for level in range(self.shard_depth):
+            folders = [os.path.join(folder, name) for folder in folders
+                       for name in os.listdir(folder)
+                       if len(name) == 2 and os.path.isdir(os.path.join(folder, name))]
+        for folder in folders:
+            for name in os.listdir(folder):
+                if self._entry_re.match(name):
+                    path = os.path.join(folder, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def collect(self):
+        """Removes expired entries, then, if the cache is larger than
+        max_size, the oldest entries until it is no larger than gc_low_water
+        of max_size. Returns the number of entries removed."""
+        now = time.time()
+        removed = 0
+        entries = []
+        total = 0
+        for path, size, mtime in self._entries():
+            if self.ttl is not None and mtime + self.ttl < now:
+                self._remove(path)
+                removed += 1
+                continue
+            entries.append((mtime, size, path))
+            total += size
+        if self.max_size is not None and total > self.max_size:
+            target = self.max_size * self.gc_low_water
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+                self._remove(path)
+                total -= size
+                removed += 1
+        self._gc_lock.acquire()
+        self._size = total
+        self._last_gc = now
+        self._gc_lock.release()
+        self._count('collected', removed)
+        return removed
+
+
+class SqliteCacheHandler(CacheHandler):
+    """Cache handler storing every entry in a single SQLite database, which
+    can be shared by worker processes on the same host.
+
+    The database runs in WAL mode so readers do not block the writer. Writes
+    are buffered and committed in batches of sqlite_batch_size, and at most
+    sqlite_flush_interval seconds after they are made, by a timer thread;
+    buffered entries are visible to gets from this handler straight away
+    and to other handlers once committed. Anything still buffered is
+    committed at exit. Expiry times are indexed so purge() is cheap.
+
+    Options:
+        sqlite_path:            database file (default py-diffbot.sqlite in tmp)
+        sqlite_ttl:             seconds entries are valid (default forever)
+        sqlite_batch_size:      writes buffered before a commit (default 50)
+        sqlite_flush_interval:  seconds writes are buffered at most (default 1)
+    """
+
+    ttl = None
+    batch_size = 50
+    flush_interval = 1.0
+
+    def __init__(self, options):
+        import tempfile
+
+        CacheHandler.__init__(self, options)
+        options = options or {}
+        self.path = options.get('sqlite_path',
+                                os.path.join(tempfile.gettempdir(), 'py-diffbot.sqlite'))
+        self.ttl = options.get('sqlite_ttl', self.ttl)
+        self.batch_size = options.get('sqlite_batch_size', self.batch_size)
+        self.flush_interval = options.get('sqlite_flush_interval', self.flush_interval)
+        self._local = threading.local()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._last_flush = time.time()
+        self._timer = None
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, "
+                   "value BLOB, created REAL, expires REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+        db.commit()
+        _sqlite_handlers.add(self)
+
+    def _db(self):
+        import sqlite3
+
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout = 30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        return self.get_multi([key]).get(key, False)
+
+    def get_multi(self, keys):
+        now = time.time()
+        values = {}
+        missing = []
+        self._pending_lock.acquire()
+        try:
+            for key in keys:
+                entry = self._pending.get(key)
+                if entry is not None:
+                    values[key] = entry[0]
+                else:
+                    missing.append(key)
+        finally:
+            self._pending_lock.release()
+        db = self._db()
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            rows = db.execute("SELECT key, value FROM cache WHERE key IN (%s) "
+                              "AND (expires IS NULL OR expires > ?)"
+                              % ','.join('?' * len(chunk)), chunk + [now])
+            for key, value in rows:
+                values[key] = str(value)
+        return dict([(key, self.decode(value)) for key, value in values.items()])
+
+    def set(self, key, value):
+        return not self.set_multi({key: value})
+
+    def set_multi(self, mapping):
+        now = time.time()
+        expires = self.ttl is not None and now + self.ttl or None
+        self._pending_lock.acquire()
+        try:
+            for key, value in mapping.items():
+                self._pending[key] = (self.encode(value), now, expires)
+            due = (len(self._pending) >= self.batch_size
+                   or now - self._last_flush >= self.flush_interval)
+            if not due and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        finally:
+            self._pending_lock.release()
+        if due:
+            return self.flush()
+        return []
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception, e:
+            logging.exception(e)
+
+    def flush(self):
+        """Commits buffered writes. Returns the keys that could not be stored"""
+        import sqlite3
+
+        self._pending_lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+            timer, self._timer = self._timer, None
+        finally:
+            self._pending_lock.release()
+        if timer is not None:
+            timer.cancel()
+            # a cancelled timer still has to run down; left alone at exit it
+            # can be torn down mid-way by the interpreter
+            if timer is not threading.current_thread():
+                timer.join()
+        if not pending:
+            return []
+        rows = [(key, sqlite3.Binary(value), created, expires)
+                for key, (value, created, expires) in pending.items()]
+        db = self._db()
+        try:
+            db.executemany("INSERT OR REPLACE INTO cache (key, value, created, expires) "
+                           "VALUES (?, ?, ?, ?)", rows)
+            db.commit()
+        except sqlite3.Error, e:
+            logging.error("Exception: could not write to %s" % self.path)
+            logging.exception(e)
+            db.rollback()
+            return pending.keys()
+        return []
+
+    def purge(self):
+        """Deletes expired entries. Returns the number of entries removed"""
+        db = self._db()
+        removed = db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),)).rowcount
+        db.commit()
+        self._count('purged', removed)
+        return removed
+
+# handlers whose buffered writes are committed at exit, held weakly so
+# handlers can still be collected
+_sqlite_handlers = weakref.WeakSet()
+
+def _flush_sqlite_handlers():
+    for sqlite_handler in list(_sqlite_handlers):
+        sqlite_handler.flush()
+
+atexit.register(_flush_sqlite_handlers)
+
+
+class MemoryCacheHandler(CacheHandler):
+    """In-process LRU cache bounded by entry count and total bytes, with a
+    per-entry TTL. Safe to share between threads.
+
+    If a backend handler is given this acts as the first tier of a two-level
+    cache: misses fall through to the backend and are kept in memory, and
+    writes go to both tiers.
+
+    Options:
+        memory_max_entries:     entries kept in memory (default 1000)
+        memory_max_bytes:       total size of values kept (default 64MB)
+        memory_ttl:             seconds an entry is served from memory (default 3600)
+    """
+
+    def __init__(self, options, backend = None):
+        CacheHandler.__init__(self, options)
+        options = options or {}
+        self.max_entries = options.get('memory_max_entries', 1000)
+        self.max_bytes = options.get('memory_max_bytes', 64 * 1024 * 1024)
+        self.ttl = options.get('memory_ttl', 60 * 60)
+        self.backend = backend
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires, size = entry
+            if expires < time.time():
+                self._bytes -= size
+                self._count('expired')
+                return None
+            self._entries[key] = entry
+            return value
+        finally:
+            self._lock.release()
+
+    def _store(self, key, value, ttl = None, size = None):
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        expires = time.time() + (ttl or self.ttl)
+        evicted = 0
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, expires, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                old_key, old = self._entries.popitem(last = False)
+                self._bytes -= old[2]
+                evicted += 1
+        finally:
+            self._lock.release()
+        if evicted:
+            self._count('evictions', evicted)
+
+    def get(self, key):
+        value = self._lookup(key)
+        if value is not None:
+            self._count('hits')
+            return value
+        self._count('misses')
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value:
+                self._store(key, value)
+                return value
+        return False
+
+    def set(self, key, value, ttl = None):
+        self._store(key, value, ttl)
+        if self.backend is not None:
+            return self.backend.set(key, value)
+        return True
+
+    def get_object(self, key):
+        obj = self._lookup(key)
+        if obj is not None:
+            self._count('hits')
+            return obj
+        self._count('misses')
+        if self.backend is not None:
+            val = self.backend.get(key)
+            if val:
+                import marshal
+
+                try:
+                    obj = marshal.loads(val)
+                except (ValueError, EOFError, TypeError):
+                    return None
+                self._store(key, obj, size = len(val))
+                return obj
+        return None
+
+    def set_object(self, key, obj):
+        """Keeps obj itself in memory, so hits return it without decoding"""
+        import marshal
+
+        val = marshal.dumps(obj, 2)
+        self._store(key, obj, size = len(val))
+        if self.backend is not None:
+            return self.backend.set(key, val)
+        return True
+
+    def get_multi(self, keys):
+        values = {}
+        missing = []
+        for key in keys:
+            value = self._lookup(key)
+            if value is not None:
+                values[key] = value
+            else:
+                missing.append(key)
+        self._count('hits', len(values))
+        self._count('misses', len(missing))
+        if missing and self.backend is not None:
+            found = self.backend.get_multi(missing)
+            for key, value in found.items():
+                self._store(key, value)
+            values.update(found)
+        return values
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self._store(key, value)
+        if self.backend is not None:
+            return self.backend.set_multi(mapping)
+        return []
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+        finally:
+            self._lock.release()
+
+    def set_metrics(self, metrics):
+        CacheHandler.set_metrics(self, metrics)
+        if self.backend is not None and self.backend.metrics is NULL_METRICS:
+            self.backend.set_metrics(metrics)
+
+    def stats(self):
+        stats = CacheHandler.stats(self)
+        self._lock.acquire()
+        try:
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        finally:
+            self._lock.release()
+        return stats
+
+
+class CursorStore(object):
+    """Stores the follow_read cursor for each follow id in a cache handler.
+
+    A cursor is a dict of item id to item fingerprint. Without a cache handler
+    (or with the NullHandler) cursors are kept in memory for the life of the
+    process.
+    """
+
+    def __init__(self, cache = None):
+        if isinstance(cache, AsyncCacheHandler):
+            cache = cache.cache
+        if cache is None or isinstance(cache, NullHandler):
+            cache = MemoryCacheHandler({'memory_max_entries': 100000,
+                                        'memory_ttl': 60 * 60 * 24 * 365})
+        self.cache = cache
+
+    def key(self, follow_id):
+        return self.cache.hash('cursor:%s' % follow_id)
+
+    def get(self, follow_id):
+        return self.cache.get_object(self.key(follow_id)) or {}
+
+    def set(self, follow_id, cursor):
+        return self.cache.set_object(self.key(follow_id), cursor)
+
 
 #---------------------------------------------------------------------------
 #     Handler Class
 #---------------------------------------------------------------------------
 
 
-def handler(cache_options = None):
+def backend_handler(cache_options = None):
+    """Returns the shared (file or memcache) cache handler for the options"""
+    gae = compat.gae()
     if cache_options:
         if cache_options.has_key('handler'):
-            if cache_options['handler'] == 'memcache' and GAE:
+            if cache_options['handler'] == 'memcache' and gae:
                 return GAEMemcacheHandler(cache_options)
-            elif cache_options['handler'] == 'memcache' and LOCAL_MEMCACHE:
+            elif cache_options['handler'] == 'memcache':
+                # raises if no memcache client library is installed, rather
+                # than quietly not caching
                 return MemcacheHandler(cache_options)
             elif cache_options['handler'] == 'file':
                 return FileCacheHandler(cache_options)
-    if GAE:
+            elif cache_options['handler'] == 'sqlite':
+                return SqliteCacheHandler(cache_options)
+            elif cache_options['handler'] == 'memory':
+                return NullHandler(cache_options)
+    if gae:
         return GAEMemcacheHandler(cache_options)
-    if LOCAL_MEMCACHE and cache_options.has_key('memcache_server'):
+    if cache_options and cache_options.has_key('memcache_server'):
         return MemcacheHandler(cache_options)
     return NullHandler(cache_options)
+
+def handler(cache_options = None):
+    """Returns the cache handler for the options. With handler set to memory,
+    or memory set to True in front of another handler, an in-process
+    MemoryCacheHandler is used as the first tier."""
+    backend = backend_handler(cache_options)
+    if cache_options and (cache_options.get('memory') or cache_options.get('handler') == 'memory'):
+        if isinstance(backend, NullHandler):
+            backend = None
+        return MemoryCacheHandler(cache_options, backend)
+    return backend
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - compat.py
+
+    Probes for optional dependencies and platform libraries. Each probe runs
+    on first use and its answer is cached, so nothing optional is imported
+    when the package is.
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+_modules = {}
+
+# ElementTree implementations, fastest first
+ETREE_MODULES = (
+    'lxml.etree',
+    'xml.etree.cElementTree',       # Python 2.5
+    'xml.etree.ElementTree',        # Python 2.5
+    'cElementTree',                 # normal cElementTree install
+    'elementtree.ElementTree',      # normal ElementTree install
+)
+
+def module(name):
+    """Returns the module name, or None if it can not be imported. The
+    answer is cached."""
+    try:
+        return _modules[name]
+    except KeyError:
+        pass
+    try:
+        __import__(name)
+        import sys
+        found = sys.modules[name]
+    except ImportError:
+        found = None
+    _modules[name] = found
+    return found
+
+def first(names):
+    """Returns the first of the modules names that can be imported, or None"""
+    for name in names:
+        found = module(name)
+        if found is not None:
+            return found
+    return None
+
+def etree():
+    """Returns the best available ElementTree implementation"""
+    found = first(ETREE_MODULES)
+    if found is None:
+        raise ImportError("No ElementTree implementation found")
+    return found
+
+def gae():
+    """True when running on Google App Engine"""
+    return module('google.appengine.api') is not None
+
+def memcache_client():
+    """Returns 'memcache' if python-memcached is installed, 'pymemcache' if
+    pymemcache is, or None"""
+    if module('memcache') is not None:
+        return 'memcache'
+    if module('pymemcache.client.hash') is not None:
+        return 'pymemcache'
+    return None
+
+def capabilities():
+    """Returns a dict describing the optional dependencies available"""
+    tree = first(ETREE_MODULES)
+    return {
+        'gae': gae(),
+        'memcache': memcache_client(),
+        'etree': tree and tree.__name__,
+        'ijson': module('ijson') is not None,
+    }
@@ -17,7 +17,8 @@
 __version__ = '0.0.2'
 __author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
 
-import os, sys, logging, urlparse, urllib
+import os, sys, time, logging
+from cStringIO import StringIO
 
 try:
     import json
@@ -27,65 +28,84 @@ except ImportError:
     except ImportError:
         _JSON = False
 
-try:
-    from lxml import etree
-except ImportError:
-    try:
-        # Python 2.5
-        import xml.etree.cElementTree as etree
-    except ImportError:
-        try:
-            # Python 2.5
-            import xml.etree.ElementTree as etree
-        except ImportError:
-            try:
-                # normal cElementTree install
-                import cElementTree as etree
-            except ImportError:
-                # normal ElementTree install
-                try:
-                    import elementtree.ElementTree as etree
-                except ImportError:
-                    _ETREE = False
+# optional and platform dependent modules (ijson, ElementTree) are probed
+# on first use, see compat.py
+import compat
+from metrics import NULL_METRICS
 
 
+class DiffBotError(Exception):
+    """Raised for failed API requests in batch operations"""
 
-class DiffBot():
-    """DiffBot API Client
+class _StreamClosed(Exception):
+    """Raised in a streaming read once its reader has gone away"""
 
-    Make requests to the DiffBot API. Client library has built-in support for
-    multiple http client libraries, caching with a local file cache and memcache
-    and Google App Engine (defaults to urlfetch and memcache).
 
-    Initialization options are caching options and developer token, which is
-    required for all requests.
-
-    Usage:
-
-    >>> import diffbot
-    >>> db = diffbot.DiffBot(dev_token="mydevtoken")
-    >>> db.article("http://www.newssite.com/newsarticle.html")
-    [parsed article here]
-
-    :since: v0.1
-    """
+class BaseDiffBot():
+    """Configuration and request building shared by the DiffBot and
+    AsyncDiffBot clients"""
 
     api_endpoint_base = "http://www.diffbot.com/api/"
     request_attempts = 3
 
-    def __init__(self, cache_options = None, dev_token = None, attempts = 3):
+    def __init__(self, cache_options = None, dev_token = None, attempts = 3, http_options = None,
+                 cursor_store = None, keep_raw_response = True, metrics = None,
+                 compact_articles = False):
         """Initialize the DiffBot API client. Parameters are cache options and the
         required developer token.
 
         Cache options as a dict with key:
-            handler:                            memcache or file
+            handler:                            memcache, file, sqlite or memory
             cache_dir:                        if file cache, use cache folder (default tmp)
+            cache_ttl:                        if file cache, seconds entries are valid
+            cache_max_size:             if file cache, total bytes kept on disk
             memcache_server:            memcache server IP address
             memcache_user:                memcache username
+            memcache_ttl:                  seconds memcache entries are kept
+            sqlite_path:                    if sqlite cache, database file
+            sqlite_ttl:                      if sqlite cache, seconds entries are valid
+            cache_compress:             zlib or bz2 to compress stored entries
+            cache_parsed:                 cache parsed articles instead of responses
+            cache_soft_ttl:             seconds before entries are refreshed in the background
+            cache_hard_ttl:             seconds before entries are no longer served
+            cache_negative_ttl:     seconds failed requests are remembered
+            cache_strip_params:     tracking parameters left out of cache keys
+            memory:                              keep an in-process LRU tier in front
+            memory_max_entries:     entries kept in the memory tier
+            memory_max_bytes:         bytes kept in the memory tier
+            memory_ttl:                      seconds entries live in the memory tier
 
         dev_token is a required developer token
 
         attempts is the number of http request attempts to make on failure
+
+        cursor_store is the cache.CursorStore used by follow_read with
+        changes_only (default one built on the cache handler)
+
+        keep_raw_response set to False ignores dirty_hack, so the raw response
+        is never kept alongside the parsed article
+
+        metrics is a metrics.Metrics receiving timings and counters from the
+        client, its http handler and its cache handler
+
+        compact_articles set to True returns articles as article.Article
+        objects, which support the same dict-style access but take less
+        memory when many are kept
+
+        HTTP options as a dict with key:
+            handler:                            pool, urllib, urllib2 or urlfetch
+            pool_size:                        idle keep-alive connections per host
+            pool_idle_timeout:        seconds an idle connection is kept
+            timeout:                            socket timeout in seconds, per attempt
+            stream:                              parse responses while they are read
+            deadline:                          seconds allowed for all attempts of a request
+            retry_backoff:                first retry backoff in seconds, doubled each attempt
+            retry_max_backoff:        longest retry backoff in seconds
+            rate_limit:                      requests per second allowed
+            rate_burst:                      requests allowed in a burst
+            rate_limit_file:            file shared by processes for the rate limit
+            adaptive_concurrency:   maximum concurrent requests, reduced
+                                                        while the server returns 429 or 5xx
         """
         if not dev_token:
             dev_token = os.environ.get('DIFFBOT_TOKEN', False)
@@ -94,10 +114,21 @@ class DiffBot():
             raise Exception("Please provide a dev_token")
 
         self.dev_token = dev_token
-
+        self._cursor_store = cursor_store
+        self.keep_raw_response = keep_raw_response
+        self.compact_articles = compact_articles
+        self.metrics = metrics or NULL_METRICS
+
+        http_options = dict(http_options or {})
+        http_options.setdefault('attempts', attempts)
+        if metrics is not None:
+            http_options.setdefault('metrics', metrics)
+        self._http_handle = self._make_http_handler(cache_options, http_options)
+
+    def _make_http_handler(self, cache_options, http_options):
         from handlers import handler
 
-        self._http_handle = handler()(cache_options)
+        return handler(http_options)(cache_options, http_options)
 
     def http_handler(self):
         """Returns the http handler object, which implements handlers.HttpHandler.
@@ -108,12 +139,8 @@ class DiffBot():
         """
         return self._http_handle
 
-    def article(self, url, format = 'json', comments = False, stats = False, dirty_hack = False):
-        """Make an API request to the DiffBot server to retrieve an article.
-
-        Requires article_url
-        """
-
+    def _article_request(self, url, format = 'json', comments = False, stats = False):
+        """Returns the (api_endpoint, api_arguments) pair for an article request"""
         api_arguments = {
             "token": self.dev_token,
             "url": url,
@@ -126,49 +153,154 @@ class DiffBot():
         if stats:
             api_arguments['stats'] = True
 
-        api_endpoint = self.api_endpoint_base + 'article'
+        return self.api_endpoint_base + 'article', api_arguments
 
-        response = self.http_handler().get(api_endpoint, api_arguments)
-        
-        if response:
-            try:
-                article_info = json.loads(response)
-            except Exception, e:
-                logging.exception(e)
-                return False
-            if not article_info.has_key('tags'):
-                article_info['tags'] = []
-            if dirty_hack:
-                article_info['raw_response'] = response
-            else:
-                article_info['raw_response'] = ''
-            return article_info
+    def _article(self, article_info):
+        """Returns article_info as the result type selected by compact_articles"""
+        if article_info and self.compact_articles:
+            from article import Article
 
-        # logging.info(response)
-        logging.info('DONE!')
-        return False
+            return Article(article_info)
+        return article_info
 
-    def follow_add(self, url):
-        """Make an API request to the DiffBot server to follow a page."""
+    def _follow_add_request(self, url):
+        """Returns the (api_endpoint, api_arguments) pair for a follow request"""
         api_arguments = {
             "token": self.dev_token,
             "url": url,
         }
 
-        api_endpoint = self.api_endpoint_base + 'add'
+        return self.api_endpoint_base + 'add', api_arguments
+
+    def _follow_read_request(self, follow_id):
+        """Returns the (api_endpoint, api_arguments) pair for a follow read"""
+        api_arguments = {"id": str(follow_id)}
+
+        return self.api_endpoint_base + 'dfs/dml/archive', api_arguments
+
+    def cursor_store(self):
+        """Returns the cache.CursorStore holding the follow_read cursors"""
+        if self._cursor_store is None:
+            from cache import CursorStore
+
+            self._cursor_store = CursorStore(self.http_handler().cache_handler())
+        return self._cursor_store
+
+    def _changes(self, follow_id, items):
+        """Yields the items that are new or changed since the cursor stored for
+        follow_id, and replaces the cursor with the items seen. Items that are
+        not reached (if iteration stops early) are delivered again next time."""
+        store = self.cursor_store()
+        previous = store.get(follow_id)
+        cursor = {}
+        try:
+            for item in items:
+                fingerprint = item_fingerprint(item)
+                # items with neither an id nor a link are known by their content
+                key = item.get('id') or item.get('link') or fingerprint
+                cursor[key] = fingerprint
+                if previous.get(key) != fingerprint:
+                    yield item
+        finally:
+            store.set(follow_id, cursor)
+
+
+class DiffBot(BaseDiffBot):
+    """DiffBot API Client
+
+    Make requests to the DiffBot API. Client library has built-in support for
+    multiple http client libraries, caching with a local file cache and memcache
+    and Google App Engine (defaults to urlfetch and memcache).
+
+    Initialization options are caching options and developer token, which is
+    required for all requests.
+
+    Usage:
+
+    >>> import diffbot
+    >>> db = diffbot.DiffBot(dev_token="mydevtoken")
+    >>> db.article("http://www.newssite.com/newsarticle.html")
+    [parsed article here]
+
+    :since: v0.1
+    """
+
+    def _fetch_article(self, api_endpoint, api_arguments, dirty_hack = False):
+        """Fetches and parses an article, raising an exception if the response
+        can not be parsed. With dirty_hack the raw response is needed, so any
+        cached parsed article is bypassed and the response is not streamed."""
+        with self.metrics.timer('diffbot.article'):
+            if dirty_hack and self.keep_raw_response:
+                response = self.http_handler().get(api_endpoint, api_arguments)
+                return response and self._article(parse_article(response, dirty_hack))
+            return self._article(self.http_handler().get(api_endpoint, api_arguments,
+                                                         parse = parse_article,
+                                                         load = load_article))
+
+    def article(self, url, format = 'json', comments = False, stats = False, dirty_hack = False):
+        """Make an API request to the DiffBot server to retrieve an article.
+
+        Requires article_url
+        """
+        api_endpoint, api_arguments = self._article_request(url, format, comments, stats)
+
+        try:
+            article_info = self._fetch_article(api_endpoint, api_arguments, dirty_hack)
+        except Exception, e:
+            logging.exception(e)
+            return False
+
+        if article_info:
+            return article_info
+
+        # logging.info(response)
+        logging.info('DONE!')
+        return False
+
+    def articles(self, urls, max_workers = 4, max_in_flight = None, ordered = True,
+                 format = 'json', comments = False, stats = False, dirty_hack = False):
+        """Retrieve a batch of articles concurrently on a pool of max_workers
+        threads.
+
+        Returns an iterator of (url, article_info, error) tuples, in the order
+        of urls if ordered is set and otherwise as requests complete. error is
+        None on success and the exception for that url on failure. At most
+        max_in_flight urls are pending at once (default twice max_workers).
 
+        Cache hits are answered on the calling thread without taking a worker.
 
-        response = self.http_handler().post(api_endpoint, api_arguments)
+        >>> for url, article, error in db.articles(urls, max_workers = 8):
+        ...     print url, error or article['title']
+        """
+        import pool
+
+        cache = self.http_handler().cache_handler()
+
+        def cached(url):
+            api_endpoint, api_arguments = self._article_request(url, format, comments, stats)
+            if dirty_hack and self.keep_raw_response:
+                response = cache.lookup(api_endpoint, api_arguments)
+                return response and self._article(parse_article(response, dirty_hack))
+            return self._article(cache.lookup(api_endpoint, api_arguments, parse_article))
+
+        def fetch(url):
+            api_endpoint, api_arguments = self._article_request(url, format, comments, stats)
+            article_info = self._fetch_article(api_endpoint, api_arguments, dirty_hack)
+            if not article_info:
+                raise DiffBotError("Request failed for %s" % url)
+            return article_info
+
+        return pool.imap(fetch, urls, max_workers, max_in_flight, ordered, resolve = cached)
+
+    def follow_add(self, url):
+        """Make an API request to the DiffBot server to follow a page."""
+        api_endpoint, api_arguments = self._follow_add_request(url)
+
+        with self.metrics.timer('diffbot.follow_add'):
+            response = self.http_handler().post(api_endpoint, api_arguments)
         if response:
             try:
-                tree = etree.fromstring(response)
-                add_info = {
-                    'id': tree.get('id'),
-                    'new': tree[0].get('new') or False
-                }
-                for element in tree[0]:
-                    add_info[element.tag] = element.text
-                return add_info
+                return parse_follow_add(response)
             except Exception, e:
                 logging.exception(e)
                 return False
@@ -177,7 +309,7 @@ class DiffBot():
         logging.info('DONE!')
         return False
 
-    def follow_read(self, follow_id):
+    def follow_read(self, follow_id, changes_only = False):
         """
             Make an API request to the DiffBot server to read changes from a page.
             Returns the following dictionary:
@@ -186,43 +318,378 @@ class DiffBot():
                     #information about the request
                 },
                 'items': [] # The page's items returned by the API
+
+            If changes_only is set, items only contains the items that are new
+            or have changed since the last read of follow_id with changes_only.
         """
-        api_arguments = {"id": str(follow_id)}
+        api_endpoint, api_arguments = self._follow_read_request(follow_id)
 
-        api_endpoint = self.api_endpoint_base + 'dfs/dml/archive'
+        try:
+            with self.metrics.timer('diffbot.follow_read'):
+                read_info = self.http_handler().get(api_endpoint, api_arguments,
+                                                    parse = parse_follow_read,
+                                                    load = load_follow_read)
+        except Exception, e:
+            logging.exception(e)
+            return False
+        if read_info:
+            if changes_only:
+                read_info['items'] = list(self._changes(follow_id, read_info['items']))
+            return read_info
 
+        # logging.info(response)
+        logging.info('DONE!')
+        return False
 
-        response = self.http_handler().get(api_endpoint, api_arguments)
-        if response:
+    def follow_read_iter(self, follow_id, info = None, changes_only = False):
+        """
+            Make an API request to the DiffBot server to read changes from a
+            page, yielding each item as it is parsed rather than building the
+            whole list. If an info dict is given it is updated with the
+            information about the request once that has been read.
+            changes_only is the same as for follow_read.
+
+            If the http handler streams, items are parsed from the response
+            as it arrives and the first is yielded before the rest of the
+            archive has been read, so memory use does not grow with its size.
+            Such responses bypass the cache, since it stores whole bodies.
+            Otherwise the response is fetched (or read from the cache) whole
+            before it is parsed.
+
+            Raises DiffBotError if the request fails or the response can not
+            be parsed.
+        """
+        items = self._follow_read_items(follow_id, info)
+        if changes_only:
+            items = self._changes(follow_id, items)
+        return items
+
+    # parsed elements buffered between a streaming response and its reader
+    stream_buffer = 64
+
+    def _follow_read_items(self, follow_id, info):
+        api_endpoint, api_arguments = self._follow_read_request(follow_id)
+
+        http = self.http_handler()
+        if getattr(http, 'stream', False):
+            events = self._stream_follow_read(follow_id, api_endpoint, api_arguments)
+        else:
+            response = http.get(api_endpoint, api_arguments)
+            if not response:
+                raise DiffBotError("Request failed for follow %s" % follow_id)
+            events = iter_follow_read(StringIO(response))
+        try:
+            for kind, value in events:
+                if kind == 'item':
+                    yield value
+                elif info is not None:
+                    info.update(value)
+        except SyntaxError, e:
+            raise DiffBotError("Could not parse follow %s: %s" % (follow_id, e))
+        finally:
+            events.close()
+
+    def _stream_follow_read(self, follow_id, api_endpoint, api_arguments):
+        """Yields the parsed elements of a follow read response while it is
+        read by the http handler on another thread. Closing the generator
+        stops the read and drops the connection."""
+        import threading, Queue
+
+        events = Queue.Queue(self.stream_buffer)
+        stopped = threading.Event()
+        loaded = []
+
+        def put(event):
+            while not stopped.isSet():
+                try:
+                    return events.put(event, True, 0.1)
+                except Queue.Full:
+                    pass
+            raise _StreamClosed()
+
+        def load(fh):
+            # a retry after elements were yielded would yield them again
+            if loaded:
+                raise DiffBotError("Response for follow %s was interrupted" % follow_id)
+            loaded.append(True)
+            for event in iter_follow_read(fh):
+                put(event)
+            return True
+
+        def read():
             try:
-                tree = etree.fromstring(response)
-                read_info = {
-                    'info': {
-                        'id': tree[0].get('id'),
-                        'new': tree[0][0].get('new') or False,
-                    },
-                    'items': []
-                }
-                for element in tree[0][0]:
-                    read_info['info'][element.tag] = element.text
-                for item_element in tree[0].findall('item'):
-                    item = item_element.attrib
-                    for element in item_element:
-                        item[element.tag] = element.text
-                    read_info['items'].append(item)
-                return read_info
+                event = ('done', self.http_handler().fetch(api_endpoint, api_arguments,
+                                                           'GET', load))
+            except _StreamClosed:
+                return
             except Exception, e:
-                logging.exception(e)
+                event = ('error', e)
+            try:
+                put(event)
+            except _StreamClosed:
+                pass
+
+        thread = threading.Thread(target = read)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                try:
+                    kind, value = events.get(True, 1)
+                except Queue.Empty:
+                    continue
+                if kind == 'done':
+                    if not value:
+                        raise DiffBotError("Request failed for follow %s" % follow_id)
+                    return
+                if kind == 'error':
+                    raise value
+                yield kind, value
+        finally:
+            stopped.set()
+
+    def follow_add_many(self, urls, max_workers = 4, max_in_flight = None):
+        """Follow a batch of pages concurrently on a pool of max_workers
+        threads, which share the http handler and its connection pool.
+
+        Returns a dict mapping each url to an (add_info, error) tuple, where
+        error is None on success and the exception for that url on failure.
+
+        >>> for url, (add_info, error) in db.follow_add_many(urls).items():
+        ...     print url, error or add_info['id']
+        """
+        def add(url):
+            api_endpoint, api_arguments = self._follow_add_request(url)
+            with self.metrics.timer('diffbot.follow_add'):
+                add_info = self.http_handler().post(api_endpoint, api_arguments,
+                                                    parse = parse_follow_add)
+            if not add_info:
+                raise DiffBotError("Request failed for %s" % url)
+            return add_info
+
+        return self._many(add, urls, max_workers, max_in_flight)
+
+    def follow_read_many(self, follow_ids, max_workers = 4, max_in_flight = None,
+                         changes_only = False):
+        """Read a batch of followed pages concurrently on a pool of
+        max_workers threads. Each response is parsed on the worker that
+        fetched it (as it is read, if streaming is enabled).
+
+        Returns a dict mapping each follow_id to a (read_info, error) tuple,
+        where error is None on success and the exception for that id on
+        failure. changes_only is the same as for follow_read.
+        """
+        def read(follow_id):
+            api_endpoint, api_arguments = self._follow_read_request(follow_id)
+            with self.metrics.timer('diffbot.follow_read'):
+                read_info = self.http_handler().get(api_endpoint, api_arguments,
+                                                    parse = parse_follow_read,
+                                                    load = load_follow_read)
+            if not read_info:
+                raise DiffBotError("Request failed for follow %s" % follow_id)
+            if changes_only:
+                read_info['items'] = list(self._changes(follow_id, read_info['items']))
+            return read_info
+
+        return self._many(read, follow_ids, max_workers, max_in_flight)
+
+    def _many(self, func, keys, max_workers, max_in_flight):
+        import pool
+
+        results = {}
+        for key, result, error in pool.imap(func, keys, max_workers, max_in_flight,
+                                            ordered = False):
+            results[key] = (result, error)
+        return results
+
+
+class AsyncDiffBot(BaseDiffBot):
+    """Asynchronous DiffBot API Client
+
+    Runs requests on a single asyncore event loop rather than blocking the
+    caller, so many extractions can be in flight from one thread. article,
+    follow_add and follow_read mirror the DiffBot methods but return a
+    handlers.AsyncResult; the loop is driven by run() or by waiting on a
+    result. Batches are made by starting many requests before running the
+    loop, so the DiffBot batch and iterator methods have no counterpart.
+
+    Usage:
+
+    >>> db = diffbot.AsyncDiffBot(dev_token="mydevtoken",
+    ...                           http_options={'max_concurrency': 50})
+    >>> results = [db.article(url) for url in urls]
+    >>> db.run()
+    >>> [r.result for r in results]
+    [parsed articles here]
+
+    HTTP options as a dict with key:
+        max_concurrency:            connections open at once (default 100)
+        timeout:                            seconds before a request is abandoned
+    """
+
+    def _make_http_handler(self, cache_options, http_options):
+        from asynchttp import AsyncHttpHandler
+
+        return AsyncHttpHandler(cache_options, http_options)
+
+    def run(self, timeout = None):
+        """Runs the event loop until every request has completed or timeout
+        seconds have passed"""
+        self.http_handler().run(timeout = timeout)
+
+    def article(self, url, format = 'json', comments = False, stats = False, dirty_hack = False):
+        """Retrieve an article. Returns an AsyncResult for the article_info"""
+        api_endpoint, api_arguments = self._article_request(url, format, comments, stats)
+
+        dirty_hack = dirty_hack and self.keep_raw_response
+
+        return self.http_handler().get(api_endpoint, api_arguments).then(
+            lambda response: response and self._article(parse_article(response, dirty_hack)))
+
+    def follow_add(self, url):
+        """Follow a page. Returns an AsyncResult for the add_info"""
+        api_endpoint, api_arguments = self._follow_add_request(url)
+
+        return self.http_handler().post(api_endpoint, api_arguments).then(
+            lambda response: response and parse_follow_add(response))
+
+    def follow_read(self, follow_id, changes_only = False):
+        """Read changes from a page. Returns an AsyncResult for the read_info.
+        changes_only is the same as for DiffBot.follow_read."""
+        api_endpoint, api_arguments = self._follow_read_request(follow_id)
+
+        def parse(response):
+            if not response:
                 return False
+            read_info = parse_follow_read(response)
+            if changes_only:
+                read_info['items'] = list(self._changes(follow_id, read_info['items']))
+            return read_info
 
-        # logging.info(response)
-        logging.info('DONE!')
-        return False
+        return self.http_handler().get(api_endpoint, api_arguments).then(parse)
 
 #---------------------------------------------------------------------------
 #     Helper Functions
 #---------------------------------------------------------------------------
 
+def parse_article(response, dirty_hack = False):
+    """Parses an article API response into the article_info dict returned by
+    DiffBot.article. Raises an exception if the response is not valid JSON."""
+    return normalize_article(json.loads(response), response, dirty_hack)
+
+def load_article(fh):
+    """Parses an article API response from a file-like object. If ijson is
+    installed the response is decoded as it is read, otherwise it is read
+    whole and decoded with json."""
+    ijson = compat.module('ijson')
+    if ijson is not None:
+        article_info = _undecimal(ijson.items(fh, '').next())
+    else:
+        article_info = json.load(fh)
+    return normalize_article(article_info)
+
+def _undecimal(value):
+    """Converts the Decimal numbers produced by ijson to int and float"""
+    import decimal
+
+    if isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = _undecimal(item)
+    elif isinstance(value, list):
+        value[:] = [_undecimal(item) for item in value]
+    elif isinstance(value, decimal.Decimal):
+        if value == value.to_integral_value():
+            return int(value)
+        return float(value)
+    return value
+
+def normalize_article(article_info, response = None, dirty_hack = False):
+    """Normalizes decoded article JSON into the article_info dict returned by
+    DiffBot.article"""
+    if not article_info.has_key('tags'):
+        article_info['tags'] = []
+    if dirty_hack:
+        article_info['raw_response'] = response
+    else:
+        article_info['raw_response'] = ''
+    return article_info
+
+def parse_follow_add(response):
+    """Parses a follow add API response into the add_info dict returned by
+    DiffBot.follow_add"""
+    tree = compat.etree().fromstring(response)
+    add_info = {
+        'id': tree.get('id'),
+        'new': tree[0].get('new') or False
+    }
+    for element in tree[0]:
+        add_info[element.tag] = element.text
+    return add_info
+
+def parse_follow_read(response):
+    """Parses a DML archive API response into the read_info dict returned by
+    DiffBot.follow_read"""
+    return load_follow_read(StringIO(response))
+
+def load_follow_read(fh):
+    """Parses a DML archive API response from a file-like object into the
+    read_info dict returned by DiffBot.follow_read"""
+    read_info = {
+        'info': None,
+        'items': []
+    }
+    for kind, value in iter_follow_read(fh):
+        if kind == 'info':
+            read_info['info'] = value
+        else:
+            read_info['items'].append(value)
+    if read_info['info'] is None:
+        raise DiffBotError("No channel info in DML archive response")
+    return read_info
+
+def item_fingerprint(item):
+    """Returns the hash Diffbot gives a DML item, or a hash of its fields if it
+    has none"""
+    if item.get('hash'):
+        return item['hash']
+    import hashlib
+
+    return hashlib.sha1(repr(sorted(item.items()))).hexdigest()
+
+def iter_follow_read(source):
+    """Incrementally parses a DML archive response from the file-like source,
+    yielding an ('info', info) tuple for the channel information and an
+    ('item', item) tuple for every item as soon as it has been read. Each
+    element is discarded once it has been yielded, so memory use does not
+    grow with the size of the archive."""
+    depth = 0
+    channel = None
+    info_seen = False
+    for event, element in compat.etree().iterparse(source, events = ('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                channel = element
+            continue
+        if depth == 3:
+            if not info_seen:
+                info_seen = True
+                info = {
+                    'id': channel.get('id'),
+                    'new': element.get('new') or False,
+                }
+                for child in element:
+                    info[child.tag] = child.text
+                yield 'info', info
+            if element.tag == 'item':
+                item = dict(element.attrib)
+                for child in element:
+                    item[child.tag] = child.text
+                yield 'item', item
+            element.clear()
+            channel.remove(element)
+        depth -= 1
+
 def init_logger(level, debug = False):
     """Sets the logging level for both the command line client and the
     client library
@@ -249,16 +716,47 @@ def set_gae():
     sys.path = sys.path + [os.path.abspath(os.path.realpath(a))]
 
 
+def read_urls(fh):
+    """Yields the urls listed one per line in fh, skipping blank lines and
+    lines starting with #"""
+    for line in fh:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def batch(db, urls, workers = 8, out = None, err = None):
+    """Retrieves the articles for urls concurrently with db, writing a JSON
+    line to out (default stdout) for each url as it completes: either
+    {"url": ..., "article": {...}} or {"url": ..., "error": "..."}. A summary
+    is written to err (default stderr). Returns the number of errors."""
+    out = out or sys.stdout
+    err = err or sys.stderr
+    count = errors = 0
+    start = time.time()
+    for url, article, error in db.articles(urls, max_workers = workers, ordered = False):
+        count += 1
+        if error is not None:
+            errors += 1
+            record = {'url': url, 'error': str(error) or error.__class__.__name__}
+        else:
+            record = {'url': url, 'article': article}
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+    elapsed = time.time() - start
+    err.write("%d urls, %d errors in %.2fs (%.1f urls/s)\n"
+              % (count, errors, elapsed, elapsed and count / elapsed or 0))
+    return errors
+
 #---------------------------------------------------------------------------
 #   Main command line application function
 #
 #   (Only for article API for now.)
 #---------------------------------------------------------------------------
 def main(debug = False):
-    import sys
+    import urlparse
     from optparse import OptionParser, SUPPRESS_HELP
 
-    parser = OptionParser(usage="%prog: [options] [url]")
+    parser = OptionParser(usage="%prog: [options] [url]\n       %prog: [options] -i FILE")
     parser.add_option('-d', '--debug', action='store_const',
                                         const=logging.DEBUG, dest='log_level')
     parser.add_option('-v', '--verbose', action='store_const',
@@ -270,6 +768,10 @@ def main(debug = False):
     parser.add_option('-o', '--output', choices=['html', 'raw', 'json', 'pretty'],
                                         dest='oformat', help="Ouput format (html, raw, json, pretty)")
     parser.add_option('-k', dest='key', help="Diffbot developer API key")
+    parser.add_option('-i', '--input', dest='input',
+                                        help="Read urls from FILE (- for stdin) and write JSON lines")
+    parser.add_option('-w', '--workers', type='int', default=8, dest='workers',
+                                        help="Concurrent requests in batch mode (default 8)")
 
     parser.add_option('-t', '--test',
                             choices=["gae", "nogae", "http", "memcache", "filecache", "h", "m", "f"],
@@ -278,6 +780,9 @@ def main(debug = False):
     (options, args) = parser.parse_args()
     init_logger(options.log_level, debug)
 
+    if options.input:
+        sys.exit(main_batch(options) and 1 or 0)
+
     if len(args) != 1:
         parser.print_help()
         sys.exit(-1)
@@ -305,7 +810,7 @@ def main(debug = False):
     # cache_options = {'handler': 'memcache'}
 
     try:
-        db = DiffBot(cache_options)
+        db = DiffBot(cache_options, dev_token = options.key)
         article = db.article(_url)
     except Exception, e:
         print "Error: ", e
@@ -320,6 +825,29 @@ def main(debug = False):
     else:
         print article
 
+def main_batch(options):
+    """Runs batch mode for the parsed command line options, sharing one
+    client (and its connection pool and cache) between every url"""
+    cache_options = {}
+    if options.cache == 'm' or options.cache == 'memcache':
+        cache_options['handler'] = 'memcache'
+    elif options.cache == 'f' or options.cache == 'file':
+        cache_options['handler'] = 'file'
+
+    try:
+        db = DiffBot(cache_options, dev_token = options.key, http_options = {'handler': 'pool'})
+    except Exception, e:
+        print >> sys.stderr, "Error: ", e
+        return -1
+
+    fh = options.input == '-' and sys.stdin or open(options.input)
+    try:
+        return batch(db, read_urls(fh), options.workers)
+    finally:
+        db.http_handler().close()
+        if fh is not sys.stdin:
+            fh.close()
+
 if __name__ == "__main__":
     main(os.environ.get('DIFFBOT_DEBUG', False))
 
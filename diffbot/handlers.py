@@ -18,29 +18,43 @@
 __version__ = '0.0.2'
 __author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
 
-GAE = True
-
-import logging
-
-try:
-    from google.appengine.api import urlfetch
-except ImportError:
-    GAE = False
-import urllib
+import logging, threading, time, errno
 
 from cache import handler as cache_handler
+from metrics import NULL_METRICS
+import compat
 
 class HttpHandler(object):
 
     _req_headers = {
         "User-Agent": "py-diffbot v0.0.2 <+http://bitbucket.org/nik/py-diffbot>"
     }
-    _req_attempts = 3
 
-    def __init__(self, cache_options = None):
+    def __init__(self, cache_options = None, options = None):
         """docstring for __init__"""
+        self.options = options or {}
+        self.stream = self.options.get('stream', False)
+        self.metrics = self.options.get('metrics') or NULL_METRICS
+        self._retry = self.options.get('retry_policy')
+        if self._retry is None:
+            self._retry = RetryPolicy(
+                attempts = self.options.get('attempts', RetryPolicy.attempts),
+                backoff = self.options.get('retry_backoff', RetryPolicy.backoff),
+                max_backoff = self.options.get('retry_max_backoff', RetryPolicy.max_backoff),
+                deadline = self.options.get('deadline'),
+                timeout = self.options.get('timeout'))
+        self._rate_limiter = self.options.get('rate_limiter')
+        if self._rate_limiter is None and self.options.get('rate_limit'):
+            self._rate_limiter = RateLimiter(self.options['rate_limit'],
+                                             self.options.get('rate_burst'),
+                                             self.options.get('rate_limit_file'))
+        self._concurrency = self.options.get('concurrency_limiter')
+        if self._concurrency is None and self.options.get('adaptive_concurrency'):
+            self._concurrency = AdaptiveConcurrency(self.options['adaptive_concurrency'])
         self._cache_handle = cache_handler(cache_options)
         if self._cache_handle:
+            if self._cache_handle.metrics is NULL_METRICS:
+                self._cache_handle.set_metrics(self.metrics)
             self.get = self._cache_handle.wrap(self.get)
             self.post = self._cache_handle.wrap(self.post)
 
@@ -51,91 +65,616 @@ class HttpHandler(object):
         logging.debug("Called __call__ with:")
         logging.debug(**kwargs)
 
-    def get(self, url, data):
-            return self.fetch(url, data, 'GET')
+    def get(self, url, data, parse = None, load = None):
+            """Returns the response body for a GET request, passed through
+            parse if given. If streaming is enabled and load is given, the
+            response is instead passed to load as a file-like object, so the
+            body is never held in memory as a whole."""
+            if load is not None and self.stream:
+                return self.fetch(url, data, 'GET', load)
+            result = self.fetch(url, data, 'GET')
+            if result and parse is not None:
+                return self.metrics.timed('parse.' + parse.__name__, parse, result)
+            return result
 
-    def post(self, url, data):
-            return self.fetch(url, data, 'POST')
+    def post(self, url, data, parse = None, load = None):
+            if load is not None and self.stream:
+                return self.fetch(url, data, 'POST', load)
+            result = self.fetch(url, data, 'POST')
+            if result and parse is not None:
+                return self.metrics.timed('parse.' + parse.__name__, parse, result)
+            return result
 
-# TODO Somebody who knows the Appengine API should fix this to function the same way as the urllib version
-class UrlfetchHandler(HttpHandler):
+    def fetch(self, url, data, method, load = None):
+        """Makes a request, subject to the rate limit and concurrency limit,
+        retrying failures as allowed by the retry policy. Returns the response
+        body, or load(response) if load is given, or False if it failed"""
+        with self.metrics.timer('http.request'):
+            return self._fetch(url, data, method, load)
 
-    def fetch(self, url, data, method):
+    def _fetch(self, url, data, method, load):
+        policy = self._retry
+        metrics = self.metrics
+        start = time.time()
         attempt = 1
-        result = None
-        self._req_headers['Connection'] = 'Close'
-
-        while attempt <= self._req_attempts:
+        while True:
+            timeout = policy.timeout_for(start)
+            if timeout is not None and timeout <= 0:
+                break
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            if self._concurrency is not None:
+                self._concurrency.acquire()
+            status = None
+            metrics.adjust('http.in_flight', 1)
             try:
-                result = urlfetch.fetch(
-                    url,
-                    method = urlfetch.GET,
-                    headers = self._req_headers,
-                    deadline = 20
-                )
-            except urlfetch.DownloadError, e:
-                logging.info("DiffBot: (Download Attempt [%d/%d]) DownloadError: Download timed out"
-                    % (attempt, self._req_attempts))
-                attempt += 1
-            except Exception, e:
-                logging.exception("Diffbot: Exception: %s" % e.message)
-                logging.exception("Diffbot: Exceeded number of attempts allowed")
-                return False
+                status, result = self._request(url, data, method, timeout, load)
+            finally:
+                metrics.adjust('http.in_flight', -1)
+                if self._concurrency is not None:
+                    self._concurrency.release(status)
+            if status == 200:
+                return result
+            metrics.incr('http.errors')
+            if status is not None:
+                logging.error("%s http request returned status code: %s"
+                              % (self.__class__.__name__, status))
+            delay = policy.delay(attempt, start)
+            if not policy.retryable(status) or attempt >= policy.attempts or delay is None:
+                break
+            logging.info("DiffBot: (Attempt [%d/%d]) retrying in %.2fs"
+                         % (attempt, policy.attempts, delay))
+            time.sleep(delay)
+            attempt += 1
+            metrics.incr('http.retries')
+        return False
 
-            if result:
-                if result.status_code == 200:
-                    return result.content
+    def _request(self, url, data, method, timeout = None, load = None):
+        """Makes a single request, giving up after timeout seconds. Returns a
+        (status, body) tuple, where status is None if no response was
+        received. If load is given and the status is 200, body is the return
+        value of load(response)."""
+        raise NotImplementedError
 
-        return False
+    def close(self):
+        """Releases any connections held by the handler"""
+        pass
+
+def _read(response, status, load, metrics = NULL_METRICS):
+    """Returns the body of response, or load(response) if load is given and
+    the request succeeded, recording the transfer time and bytes read"""
+    if not metrics.sinks:
+        if load is not None and status == 200:
+            return load(response)
+        return response.read()
+    start = time.time()
+    if load is not None and status == 200:
+        response = _CountingReader(response)
+        result = load(response)
+        length = response.bytes
+    else:
+        result = response.read()
+        length = len(result)
+    metrics.timing('http.transfer', time.time() - start)
+    metrics.incr('http.bytes', length)
+    return result
+
+class _CountingReader(object):
+    """File-like wrapper counting the bytes read through it"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.bytes = 0
+
+    def read(self, *args):
+        data = self.fh.read(*args)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.fh.readline(*args)
+        self.bytes += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+class UrlfetchHandler(HttpHandler):
+
+    def _request(self, url, data, method, timeout = None, load = None):
+        from google.appengine.api import urlfetch
+        import urllib
+
+        payload = None
+
+        if method == 'GET':
+            url = url + '?' + urllib.urlencode(data)
+        else:
+            payload = urllib.urlencode(data)
+
+        start = time.time()
+        try:
+            result = urlfetch.fetch(
+                url,
+                payload = payload,
+                method = method == 'POST' and urlfetch.POST or urlfetch.GET,
+                headers = self._req_headers,
+                deadline = timeout or 20
+            )
+        except urlfetch.DownloadError, e:
+            logging.info("DiffBot: DownloadError: Download timed out")
+            return None, None
+        except Exception, e:
+            logging.exception("Diffbot: Exception: %s" % e.message)
+            return None, None
+        self.metrics.timing('http.wait', time.time() - start)
+        self.metrics.incr('http.bytes', len(result.content))
+
+        if load is not None and result.status_code == 200:
+            from cStringIO import StringIO
+
+            return result.status_code, load(StringIO(result.content))
+        return result.status_code, result.content
 
 
 class UrllibHandler(HttpHandler):
+    """Handler using urllib, which can not time out individual attempts"""
 
-    def fetch(self, url, data, method):
-        assert method in ['GET', 'POST']
+    def _request(self, url, data, method, timeout = None, load = None):
+        import urllib, httplib
 
-        result = None
+        assert method in ['GET', 'POST']
 
+        start = time.time()
         try:
             if method == 'GET':
                 fh = urllib.urlopen(url + '?' + urllib.urlencode(data))
             elif method == 'POST':
                 fh = urllib.urlopen(url, urllib.urlencode(data))
-            if fh.getcode() != 200:
-                logging.error("urllib http request returned status code: %s" % fh.getcode())
-                return False
-            result = fh.read()
-        except Exception, e:
+            self.metrics.timing('http.wait', time.time() - start)
+            try:
+                return fh.getcode(), _read(fh, fh.getcode(), load, self.metrics)
+            finally:
+                fh.close()
+        except (IOError, httplib.HTTPException), e:
             logging.exception("urllib error: %s", str(e))
-            return False
-
-        return result
+            return None, None
 
-# TODO implement this?
 class Urllib2Handler(HttpHandler):
-    def fetch(self, url, data, method):
-        import urllib2
 
+    def _request(self, url, data, method, timeout = None, load = None):
+        import urllib, urllib2, httplib
+
+        if method == 'GET':
+            request = urllib2.Request(url + '?' + urllib.urlencode(data),
+                                      headers = self._req_headers)
+        else:
+            request = urllib2.Request(url, urllib.urlencode(data), self._req_headers)
+        start = time.time()
         try:
-            request = urllib2.Request(
-                url,
-                # api_args,
-                # headers
-                )
-            handle = urllib2.urlopen(request)
-            response = handle.read()
-            return response
-
-        except urllib2.URLError, e:
+            if timeout is not None:
+                handle = urllib2.urlopen(request, timeout = timeout)
+            else:
+                handle = urllib2.urlopen(request)
+            self.metrics.timing('http.wait', time.time() - start)
+            try:
+                return handle.getcode(), _read(handle, handle.getcode(), load, self.metrics)
+            finally:
+                handle.close()
+        except urllib2.HTTPError, e:
+            return e.code, None
+        except (urllib2.URLError, IOError, httplib.HTTPException), e:
             logging.exception(e)
-            return False
+            return None, None
+
+class RetryPolicy(object):
+    """Decides whether and when a failed request is retried.
+
+    Requests that got no response (connection errors, timeouts) or a 429 or
+    5xx status are retried up to attempts times in total, sleeping for an
+    exponential backoff with full jitter between attempts. If deadline is
+    set no attempt is started, or slept for, past deadline seconds after the
+    first, and each attempt is given at most timeout seconds.
+    """
+
+    attempts = 3
+    backoff = 0.5
+    max_backoff = 10.0
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, attempts = 3, backoff = 0.5, max_backoff = 10.0, deadline = None,
+                 timeout = None, jitter = True):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.timeout = timeout
+        self.jitter = jitter
+
+    def retryable(self, status):
+        return status is None or status in self.retry_statuses
+
+    def timeout_for(self, start):
+        """Returns the timeout for an attempt of a call started at start"""
+        if self.deadline is None:
+            return self.timeout
+        remaining = start + self.deadline - time.time()
+        if self.timeout is not None:
+            return min(self.timeout, remaining)
+        return remaining
+
+    def delay(self, attempt, start):
+        """Returns the seconds to sleep after a failed attempt, or None if the
+        deadline would be passed"""
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        if self.jitter:
+            import random
+
+            delay = random.uniform(0, delay)
+        if self.deadline is not None and time.time() + delay >= start + self.deadline:
+            return None
+        return delay
+
+
+class RateLimiter(object):
+    """Token bucket allowing rate requests per second, with bursts of up to
+    burst requests (default rate). Shared by every thread using it.
+
+    If path is given the bucket is kept in that file under an exclusive
+    lock, so every process using the same path shares the rate.
+    """
+
+    def __init__(self, rate, burst = None, path = None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.path = path
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens = 1):
+        """Blocks until tokens are available and takes them. Returns the number
+        of seconds spent waiting."""
+        waited = 0.0
+        while True:
+            self._lock.acquire()
+            try:
+                if self.path is not None:
+                    wait = self._take_shared(tokens)
+                else:
+                    wait = self._take(tokens)
+            finally:
+                self._lock.release()
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def _take(self, tokens):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0
+        return (tokens - self._tokens) / self.rate
+
+    def _take_shared(self, tokens):
+        import fcntl
+
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            state = f.read().split()
+            if len(state) == 2:
+                self._tokens, self._updated = float(state[0]), float(state[1])
+            else:
+                self._tokens, self._updated = self.burst, time.time()
+            wait = self._take(tokens)
+            f.seek(0)
+            f.truncate()
+            f.write('%r %r' % (self._tokens, self._updated))
+            f.flush()
+            return wait
+        finally:
+            f.close()
+
+
+class AdaptiveConcurrency(object):
+    """Limits concurrent requests, adapting the limit to the server.
+
+    The limit is halved when a request fails with a 429 or 5xx status (at
+    most once per backoff_interval seconds) and grows by one after each
+    limit successful requests, between min_limit and max_limit.
+    """
+
+    def __init__(self, max_limit, min_limit = 1, backoff_interval = 1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.backoff_interval = backoff_interval
+        self.limit = max_limit
+        self.in_flight = 0
+        self._successes = 0
+        self._last_backoff = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        self._cond.acquire()
+        try:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        finally:
+            self._cond.release()
+
+    def release(self, status = 200):
+        """Releases a slot, adjusting the limit based on the response status"""
+        self._cond.acquire()
+        try:
+            self.in_flight -= 1
+            now = time.time()
+            if status == 429 or (status is not None and status >= 500):
+                self._successes = 0
+                if now - self._last_backoff >= self.backoff_interval:
+                    self._last_backoff = now
+                    self.limit = max(self.min_limit, self.limit // 2)
+            elif status == 200:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self._successes = 0
+                    self.limit += 1
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive httplib connections, keyed by
+    (scheme, host, port).
+
+    At most max_size idle connections are kept per host, and connections that
+    have been idle for longer than idle_timeout seconds are closed rather than
+    reused.
+    """
+
+    def __init__(self, max_size = 10, idle_timeout = 30, timeout = None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, host, port):
+        """Returns a (connection, reused) tuple for the given host"""
+        key = (scheme, host, port)
+        now = time.time()
+        stale = []
+        conn = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        finally:
+            self._lock.release()
+        for c in stale:
+            c.close()
+        if conn is not None:
+            return conn, True
+        import httplib
+
+        if scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        if self.timeout is not None:
+            return conn_class(host, port, timeout = self.timeout), False
+        return conn_class(host, port), False
+
+    def release(self, scheme, host, port, conn):
+        """Returns a connection to the pool, closing it if the pool is full"""
+        key = (scheme, host, port)
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def evict(self):
+        """Closes all connections that have passed the idle timeout"""
+        now = time.time()
+        stale = []
+        self._lock.acquire()
+        try:
+            for key, idle in self._idle.items():
+                fresh = [(c, t) for c, t in idle if now - t <= self.idle_timeout]
+                stale.extend([c for c, t in idle if now - t > self.idle_timeout])
+                self._idle[key] = fresh
+        finally:
+            self._lock.release()
+        for conn in stale:
+            conn.close()
+
+    def close(self):
+        """Closes every idle connection in the pool"""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+
+class PooledHttpHandler(HttpHandler):
+    """HTTP/1.1 handler that reuses keep-alive connections across requests.
+
+    Options:
+        pool_size:              idle connections kept per host (default 10)
+        pool_idle_timeout:      seconds before an idle connection is dropped
+        timeout:                socket timeout in seconds
+    """
+
+    def __init__(self, cache_options = None, options = None):
+        super(PooledHttpHandler, self).__init__(cache_options, options)
+        self._pool = ConnectionPool(
+            max_size = self.options.get('pool_size', 10),
+            idle_timeout = self.options.get('pool_idle_timeout', 30),
+            timeout = self.options.get('timeout'))
+
+    def connection_pool(self):
+        return self._pool
+
+    def close(self):
+        self._pool.close()
+
+    def _request(self, url, data, method, timeout = None, load = None):
+        import urllib, urlparse, httplib
+
+        assert method in ['GET', 'POST']
+
+        parsed = urlparse.urlparse(url)
+        host = parsed.hostname
+        port = parsed.port or (parsed.scheme == 'https' and 443 or 80)
+        path = parsed.path or '/'
+        headers = dict(self._req_headers)
+        headers['Connection'] = 'keep-alive'
+        body = None
+        if method == 'GET':
+            path = path + '?' + urllib.urlencode(data)
+        else:
+            body = urllib.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        while True:
+            conn, reused = self._pool.acquire(parsed.scheme, host, port)
+            if timeout is not None:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            try:
+                if not reused and self.metrics.sinks:
+                    with self.metrics.timer('http.connect'):
+                        conn.connect()
+                start = time.time()
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                except (httplib.HTTPException, IOError), e:
+                    # a reused connection the server closed while it was idle
+                    # is retried once on a fresh connection; anything else,
+                    # timeouts included, is left to the retry policy
+                    if reused and _closed_while_idle(e):
+                        conn.close()
+                        continue
+                    raise
+                self.metrics.timing('http.wait', time.time() - start)
+                result = _read(response, response.status, load, self.metrics)
+                # drain anything load left unread so the connection can be reused
+                response.read()
+            except (httplib.HTTPException, IOError), e:
+                conn.close()
+                logging.exception("httplib error: %s", str(e))
+                return None, None
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._pool.release(parsed.scheme, host, port, conn)
+
+        return response.status, result
+
+def _closed_while_idle(error):
+    """True if error is how sending on or reading the status line from a
+    connection the server has closed fails"""
+    import httplib
+
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+class AsyncResult(object):
+    """The eventual result of an asynchronous request.
+
+    Callbacks added with add_callback are called with the result once it is
+    available; then() chains a function onto the result and returns a new
+    AsyncResult for its return value. wait() drives the event loop of the
+    handler that issued the request until the result is ready.
+    """
+
+    def __init__(self, handler = None):
+        self.handler = handler
+        self.done = False
+        self.result = None
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        if self.done:
+            callback(self.result)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self.done = True
+        self.result = result
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(result)
+
+    def then(self, func):
+        chained = AsyncResult(self.handler)
+        def callback(result):
+            try:
+                value = func(result)
+            except Exception, e:
+                logging.exception(e)
+                value = False
+            if isinstance(value, AsyncResult):
+                value.add_callback(chained.set_result)
+            else:
+                chained.set_result(value)
+        self.add_callback(callback)
+        return chained
+
+    def wait(self, timeout = None):
+        if not self.done and self.handler is not None:
+            self.handler.run(lambda: self.done, timeout)
+        return self.result
+
 
-# TODO implement options
-# TODO return an instance rather than the class (ie. pass and wrap options) and
-# TODO select the class to use based on the options (same as cache.py)
 def handler(options = None):
-    """return a valid HTTP handler for the request"""
-    if GAE:
+    """return a valid HTTP handler for the request
+
+    options may select the handler explicitly with the 'handler' key (one of
+    pool, urllib, urllib2 or urlfetch), otherwise urlfetch is used on Google
+    App Engine and urllib elsewhere.
+    """
+    gae = compat.gae()
+    if options and options.has_key('handler'):
+        if options['handler'] == 'pool':
+            return PooledHttpHandler
+        elif options['handler'] == 'urllib':
+            return UrllibHandler
+        elif options['handler'] == 'urllib2':
+            return Urllib2Handler
+        elif options['handler'] == 'urlfetch' and gae:
+            return UrlfetchHandler
+    if gae:
         return    UrlfetchHandler
     return UrllibHandler
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - metrics.py
+
+    Counters, gauges and timings collected by the client, the http handlers
+    and the cache handlers, forwarded to pluggable sinks
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+import time, math, logging, threading, collections
+
+#---------------------------------------------------------------------------
+#     Metrics
+#---------------------------------------------------------------------------
+
+class Metrics(object):
+    """Records metrics and forwards each one to every sink.
+
+    Timings are in seconds. With no sinks every call returns immediately,
+    so instrumented code costs next to nothing when metrics are not used.
+
+    Names emitted by the client:
+        diffbot.<method>            timing of each API call
+        cache.lookup                timing of a cache lookup
+        cache.hit, cache.miss       lookups answered and not answered
+        cache.<stat>                the handler's stats() counters
+        http.request                timing of a request, including retries
+        http.connect                timing of opening a new connection
+        http.wait                   timing from sending a request to its
+                                    response headers (includes connecting
+                                    for the urllib handlers)
+        http.transfer               timing of reading a body (including
+                                    parsing it when streaming)
+        http.bytes                  response bytes read
+        http.retries, http.errors   retried attempts and failed attempts
+        http.in_flight              gauge of requests in progress
+        parse.<function>            timing of each parse function
+    """
+
+    def __init__(self, sinks = None):
+        self.sinks = list(sinks or [])
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def incr(self, name, value = 1):
+        for sink in self.sinks:
+            sink.counter(name, value)
+
+    def gauge(self, name, value):
+        for sink in self.sinks:
+            sink.gauge(name, value)
+
+    def adjust(self, name, delta):
+        """Adds delta to the gauge name, which starts at 0"""
+        if not self.sinks:
+            return
+        self._lock.acquire()
+        try:
+            value = self._levels[name] = self._levels.get(name, 0) + delta
+        finally:
+            self._lock.release()
+        self.gauge(name, value)
+
+    def timing(self, name, seconds):
+        for sink in self.sinks:
+            sink.timing(name, seconds)
+
+    def timer(self, name):
+        """Returns a context manager recording the time spent in its block"""
+        if not self.sinks:
+            return _NULL_TIMER
+        return Timer(self, name)
+
+    def timed(self, name, func, *args):
+        """Returns func(*args), recording the time it took under name"""
+        if not self.sinks:
+            return func(*args)
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timing(name, time.time() - start)
+
+class Timer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.name, time.time() - self.start)
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+# shared by every handler not given a Metrics object
+NULL_METRICS = Metrics()
+
+#---------------------------------------------------------------------------
+#     Sinks
+#---------------------------------------------------------------------------
+
+class Sink(object):
+    """Base class for sinks. Subclasses override the kinds they handle."""
+
+    def counter(self, name, value):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+class MemorySink(Sink):
+    """Keeps counters, gauges and the last max_samples timings of each name
+    in memory. snapshot() summarizes them."""
+
+    def __init__(self, max_samples = 1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._counters = {}
+            self._gauges = {}
+            self._timings = {}
+        finally:
+            self._lock.release()
+
+    def counter(self, name, value):
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def gauge(self, name, value):
+        self._lock.acquire()
+        try:
+            self._gauges[name] = value
+        finally:
+            self._lock.release()
+
+    def timing(self, name, seconds):
+        self._lock.acquire()
+        try:
+            samples = self._timings.get(name)
+            if samples is None:
+                samples = self._timings[name] = [0, 0.0, collections.deque(maxlen = self.max_samples)]
+            samples[0] += 1
+            samples[1] += seconds
+            samples[2].append(seconds)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns a dict with the counters, the gauges and, for each timing,
+        its count, total, mean, min, max, p50, p90 and p99 in seconds. The
+        percentiles, min and max cover the most recent samples only."""
+        self._lock.acquire()
+        try:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = [(name, count, total, sorted(samples))
+                       for name, (count, total, samples) in self._timings.items()]
+        finally:
+            self._lock.release()
+        summaries = {}
+        for name, count, total, samples in timings:
+            summaries[name] = {
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'min': samples[0],
+                'max': samples[-1],
+                'p50': percentile(samples, 50),
+                'p90': percentile(samples, 90),
+                'p99': percentile(samples, 99),
+            }
+        hits, misses = counters.get('cache.hit', 0), counters.get('cache.miss', 0)
+        if hits + misses:
+            gauges['cache.hit_ratio'] = float(hits) / (hits + misses)
+        return {'counters': counters, 'gauges': gauges, 'timings': summaries}
+
+class StatsdSink(Sink):
+    """Sends each metric to a StatsD server over UDP. Timings are sent in
+    milliseconds. Send errors are logged and otherwise ignored."""
+
+    def __init__(self, host = '127.0.0.1', port = 8125, prefix = 'diffbot.'):
+        import socket
+
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line, self.address)
+        except EnvironmentError, e:
+            logging.debug("statsd send failed: %s" % e)
+
+    def counter(self, name, value):
+        self._send('%s%s:%d|c' % (self.prefix, name, value))
+
+    def gauge(self, name, value):
+        self._send('%s%s:%s|g' % (self.prefix, name, value))
+
+    def timing(self, name, seconds):
+        self._send('%s%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+    def close(self):
+        self._socket.close()
+
+class CallbackSink(Sink):
+    """Calls callback(kind, name, value) for every metric, where kind is
+    'counter', 'gauge' or 'timing'"""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def counter(self, name, value):
+        self.callback('counter', name, value)
+
+    def gauge(self, name, value):
+        self.callback('gauge', name, value)
+
+    def timing(self, name, seconds):
+        self.callback('timing', name, seconds)
+
+#---------------------------------------------------------------------------
+#     Helper Functions
+#---------------------------------------------------------------------------
+
+def percentile(samples, p):
+    """Returns the p-th percentile of a sorted list, by nearest rank"""
+    if not samples:
+        return None
+    index = int(math.ceil(p / 100.0 * len(samples))) - 1
+    return samples[max(0, min(len(samples) - 1, index))]
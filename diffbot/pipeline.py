@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - pipeline.py
+
+    Runs article extraction for a stream of urls across a pool of processes,
+    writing the results to a sink
+
+    Usage:
+
+    >>> from diffbot.pipeline import Pipeline, JsonlSink
+    >>> pipeline = Pipeline({'handler': 'sqlite', 'sqlite_path': '/tmp/diffbot.db'},
+    ...                     dev_token = "mydevtoken", processes = 8)
+    >>> pipeline.run(open('urls.txt'), JsonlSink('articles.jsonl'))
+    {'count': 10000, 'errors': 12, 'seconds': 95.2}
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+import sys, time, logging, itertools, threading, multiprocessing
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from diffbot import DiffBot
+
+#---------------------------------------------------------------------------
+#     Pipeline
+#---------------------------------------------------------------------------
+
+class Pipeline(object):
+    """Spreads article requests over processes worker processes.
+
+    Each worker creates its own DiffBot client (and so its own connection
+    pool) and fetches the urls of a chunk on threads threads. For the
+    workers to share cached responses the cache has to live outside the
+    process: use the file, sqlite or memcache handler.
+
+    urls are read lazily, chunk_size at a time, and at most max_pending
+    chunks (default twice processes) are dispatched and not yet consumed,
+    so a slow sink holds back reading the input rather than buffering it.
+
+    process(url, article_info), if given, runs in the worker on each
+    article and its return value is used as the result. It has to be
+    picklable, i.e. a module level function.
+    """
+
+    def __init__(self, cache_options = None, dev_token = None, http_options = None,
+                 processes = None, threads = 4, chunk_size = 16, max_pending = None,
+                 process = None, api_endpoint_base = None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or self.processes * 2
+        http_options = dict(http_options or {})
+        http_options.setdefault('handler', 'pool')
+        self._worker_args = (cache_options, dev_token, http_options, api_endpoint_base,
+                             threads, process)
+
+    def imap(self, urls, ordered = True):
+        """Yields a (url, result, error) tuple for each url, in the order of
+        urls if ordered is set and otherwise as chunks complete. error is
+        None on success and a description of the failure otherwise.
+
+        A chunk whose results can not be sent back from its worker fails as
+        a whole. If a worker process dies, every chunk in progress fails and
+        the pool is replaced before the remaining urls are dispatched."""
+        pool, workers = self._start_pool()
+        completions = threading.Event()
+        chunks = _chunks(urls, self.chunk_size)
+        pending = {}
+        submitted = emitted = 0
+        buffered = {}
+        exhausted = completed = False
+        try:
+            while True:
+                while not exhausted and submitted - emitted < self.max_pending:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    result = pool.apply_async(_run_chunk, (submitted, chunk, ordered),
+                                              callback = lambda value: completions.set())
+                    pending[submitted] = (chunk, result)
+                    submitted += 1
+                if exhausted and emitted == submitted:
+                    break
+                done = _collect(pending, completions)
+                if not done and _pids(pool) != workers:
+                    logging.error("A pipeline worker process died; failing the %d chunks "
+                                  "in progress" % len(pending))
+                    done = [(number, _failed(chunk, "worker process exited"))
+                            for number, (chunk, result) in pending.items()]
+                    pending.clear()
+                    pool.terminate()
+                    pool.join()
+                    pool, workers = self._start_pool()
+                for number, results in done:
+                    if ordered:
+                        buffered[number] = results
+                        while buffered.has_key(emitted):
+                            for result in buffered.pop(emitted):
+                                yield result
+                            emitted += 1
+                    else:
+                        for result in results:
+                            yield result
+                        emitted += 1
+            completed = True
+        finally:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def _start_pool(self):
+        pool = multiprocessing.Pool(self.processes, _init_worker, self._worker_args)
+        return pool, _pids(pool)
+
+    def run(self, urls, sink, ordered = True):
+        """Writes the result for every url to sink, then closes it. Returns
+        a dict with the count of urls, the errors and the seconds taken."""
+        count = errors = 0
+        start = time.time()
+        try:
+            for url, result, error in self.imap(urls, ordered):
+                count += 1
+                if error is not None:
+                    errors += 1
+                sink.write(url, result, error)
+        finally:
+            sink.close()
+        return {'count': count, 'errors': errors, 'seconds': time.time() - start}
+
+def _chunks(urls, size):
+    urls = (url.strip() for url in urls)
+    urls = (url for url in urls if url and not url.startswith('#'))
+    while True:
+        chunk = list(itertools.islice(urls, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _collect(pending, completions):
+    """Returns (number, results) for each pending chunk that has finished,
+    waiting up to a tenth of a second for one to. Chunks that raised in the
+    pool, such as those whose results could not be pickled, get an error for
+    each url."""
+    completions.clear()
+    done = _finished(pending)
+    if not done:
+        # failures do not call back, so the wait is bounded
+        completions.wait(0.1)
+        done = _finished(pending)
+    return done
+
+def _finished(pending):
+    done = []
+    for number, (chunk, result) in pending.items():
+        if not result.ready():
+            continue
+        del pending[number]
+        try:
+            done.append(result.get(0))
+        except Exception, e:
+            logging.error("pipeline chunk %d failed: %s" % (number, e))
+            done.append((number, _failed(chunk, _describe(e))))
+    return done
+
+def _failed(chunk, error):
+    return [(url, None, error) for url in chunk]
+
+def _pids(pool):
+    # the pool replaces a worker that dies, losing the chunk it was running
+    return set([process.pid for process in pool._pool])
+
+#---------------------------------------------------------------------------
+#     Worker processes
+#---------------------------------------------------------------------------
+
+_client = None
+_threads = 4
+_process = None
+
+def _init_worker(cache_options, dev_token, http_options, api_endpoint_base, threads, process):
+    global _client, _threads, _process
+
+    _client = DiffBot(cache_options, dev_token, http_options = http_options)
+    if api_endpoint_base:
+        _client.api_endpoint_base = api_endpoint_base
+    _threads = threads
+    _process = process
+
+def _run_chunk(number, chunk, ordered):
+    """Fetches the articles for chunk. Never raises, so that the parent is
+    always called back; failures are returned as error strings."""
+    results = []
+    try:
+        for url, result, error in _client.articles(chunk, max_workers = _threads,
+                                                   ordered = ordered):
+            if error is None and _process is not None:
+                try:
+                    result = _process(url, result)
+                except Exception, e:
+                    result, error = None, e
+            results.append((url, result, _describe(error)))
+    except Exception, e:
+        seen = set([url for url, result, error in results])
+        results.extend([(url, None, _describe(e)) for url in chunk if url not in seen])
+    _flush(_client.http_handler().cache_handler())
+    return number, results
+
+def _describe(error):
+    if error is None:
+        return None
+    return str(error) or error.__class__.__name__
+
+def _flush(cache):
+    # worker processes exit without running atexit handlers, so write out
+    # anything a cache handler is batching after every chunk
+    while cache is not None:
+        if hasattr(cache, 'flush'):
+            try:
+                cache.flush()
+            except Exception, e:
+                logging.exception(e)
+        cache = getattr(cache, 'backend', None)
+
+#---------------------------------------------------------------------------
+#     Sinks
+#---------------------------------------------------------------------------
+
+class JsonlSink(object):
+    """Writes each result as a JSON line, {"url": ..., "article": ...} or
+    {"url": ..., "error": ...}, to a file name or file object (default
+    stdout)"""
+
+    def __init__(self, out = None):
+        self._owned = isinstance(out, basestring)
+        if self._owned:
+            out = open(out, 'w')
+        self.out = out or sys.stdout
+
+    def write(self, url, result, error):
+        if error is not None:
+            record = {'url': url, 'error': error}
+        else:
+            record = {'url': url, 'article': result}
+        self.out.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self._owned:
+            self.out.close()
+        else:
+            self.out.flush()
+
+class SqliteSink(object):
+    """Writes results to a SQLite table with columns seq, url, result (as
+    JSON) and error, committing every batch_size rows"""
+
+    def __init__(self, path, table = 'articles', batch_size = 100):
+        import sqlite3
+
+        self.table = table
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (seq INTEGER PRIMARY KEY, url TEXT, '
+                        'result TEXT, error TEXT)' % table)
+        self._rows = []
+
+    def write(self, url, result, error):
+        self._rows.append((url, error is None and json.dumps(result) or None, error))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self.db.executemany('INSERT INTO %s (url, result, error) VALUES (?, ?, ?)'
+                                % self.table, self._rows)
+            self.db.commit()
+            self._rows = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
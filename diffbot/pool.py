@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - pool.py
+
+    Thread pool used to run batches of API requests concurrently
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+import threading, Queue, collections
+
+class Task(object):
+    """A unit of work submitted to a WorkerPool. Holds the result or the
+    exception raised by the function once it has run."""
+
+    def __init__(self, item, func = None, done = None):
+        self.item = item
+        self.func = func
+        self.result = None
+        self.error = None
+        self._done = done
+        self._event = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(self.item)
+        except Exception, e:
+            self.error = e
+        self.finish()
+
+    def finish(self):
+        self._event.set()
+        if self._done is not None:
+            self._done.put(self)
+
+    def wait(self):
+        self._event.wait()
+        return self
+
+
+class WorkerPool(object):
+    """Fixed size pool of daemon worker threads"""
+
+    def __init__(self, max_workers = 4):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target = self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            task.run()
+
+    def submit(self, task):
+        self._queue.put(task)
+        return task
+
+    def close(self):
+        """Stops the workers once the submitted tasks have run, and waits
+        for them to exit"""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def imap(func, items, max_workers = 4, max_in_flight = None, ordered = True, resolve = None):
+    """Calls func(item) for every item on a pool of worker threads and yields
+    (item, result, error) tuples, where error is the exception raised by func
+    or None.
+
+    Results are yielded in the order of items if ordered is set, otherwise as
+    they complete. At most max_in_flight items (default twice max_workers) are
+    pending at any time, so items may be a lazy iterator.
+
+    resolve(item) is called on the calling thread before an item is
+    submitted; if it returns anything other than None that is used as the
+    result and the item never occupies a worker.
+    """
+    if max_in_flight is None:
+        max_in_flight = max_workers * 2
+    done = Queue.Queue()
+    pending = collections.deque()
+    in_flight = 0
+    pool = WorkerPool(max_workers)
+    try:
+        for item in items:
+            task = Task(item, func, not ordered and done or None)
+            resolved = None
+            if resolve is not None:
+                try:
+                    resolved = resolve(item)
+                except Exception, e:
+                    task.error = e
+            if resolved is not None or task.error is not None:
+                task.result = resolved
+                task._done = None
+                task.finish()
+                if ordered:
+                    pending.append(task)
+                else:
+                    yield task.item, task.result, task.error
+            else:
+                pool.submit(task)
+                in_flight += 1
+                if ordered:
+                    pending.append(task)
+            while ordered and len(pending) >= max_in_flight:
+                task = pending.popleft().wait()
+                yield task.item, task.result, task.error
+            while not ordered and in_flight >= max_in_flight:
+                task = done.get()
+                in_flight -= 1
+                yield task.item, task.result, task.error
+        while pending:
+            task = pending.popleft().wait()
+            yield task.item, task.result, task.error
+        while in_flight and not ordered:
+            task = done.get()
+            in_flight -= 1
+            yield task.item, task.result, task.error
+    finally:
+        pool.close()
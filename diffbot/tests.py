@@ -1,18 +1,37 @@
 #!/usr/bin/env python
 
-import unittest
+import unittest, os, tempfile, shutil, threading, time, urllib
 
-from diffbot import DiffBot
-from handlers import HttpHandler
-from cache import CacheHandler
+from diffbot import DiffBot, AsyncDiffBot, DiffBotError, load_article
+from handlers import HttpHandler, PooledHttpHandler, RateLimiter, AdaptiveConcurrency
+from handlers import Urllib2Handler
+from cache import CacheHandler, MemoryCacheHandler, FileCacheHandler, MemcacheHandler
+from cache import SqliteCacheHandler
+import cache
+import benchmark
+from metrics import Metrics, MemorySink, StatsdSink, CallbackSink
+from article import Article
 
 class DiffBotTest(unittest.TestCase):
+    """Runs against the local stub server, or the live API if DIFFBOT_LIVE
+    is set (the dev token then has to come from DIFFBOT_TOKEN)"""
 
     def setUp(self):
-        self.diffbot = DiffBot() # dev_key has to come from the environment (DIFFBOT_KEY)
+        self.server = None
+        if os.environ.get('DIFFBOT_LIVE'):
+            self.diffbot = DiffBot()
+        else:
+            self.server = benchmark.start_server()
+            self.diffbot = DiffBot(dev_token = 'test')
+            self.diffbot.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
         self.test_url = 'http://nomulous.com/'
         self.test_url_id = self.diffbot.follow_add(self.test_url)['id']
 
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
     def test_http_handler_instance(self):
         self.assertIsInstance(self.diffbot.http_handler(), HttpHandler)
 
@@ -49,6 +68,1515 @@ class DiffBotTest(unittest.TestCase):
 
 
 
+class PooledHttpHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.url = 'http://%s:%d/api/article' % self.server.server_address
+        self.http = PooledHttpHandler(None, {'pool_size': 2})
+
+    def tearDown(self):
+        self.http.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_and_post(self):
+        self.assertEqual(self.http.get(self.url, {'url': 'a'}), benchmark.STUB_ARTICLE)
+        self.assertEqual(self.http.post(self.url, {'url': 'a'}), benchmark.STUB_ARTICLE)
+
+    def test_connection_reuse(self):
+        pool = self.http.connection_pool()
+        host, port = self.server.server_address
+        self.http.get(self.url, {'url': 'a'})
+        conn, reused = pool.acquire('http', host, port)
+        self.assertTrue(reused)
+        pool.release('http', host, port, conn)
+
+    def test_idle_eviction(self):
+        pool = self.http.connection_pool()
+        host, port = self.server.server_address
+        self.http.get(self.url, {'url': 'a'})
+        pool.idle_timeout = -1
+        pool.evict()
+        conn, reused = pool.acquire('http', host, port)
+        self.assertFalse(reused)
+        conn.close()
+
+    def test_reconnect_when_closed_while_idle(self):
+        import socket
+
+        pool = self.http.connection_pool()
+        host, port = self.server.server_address
+        self.http.get(self.url, {'url': 'a'})
+        conn, reused = pool.acquire('http', host, port)
+        conn.sock.shutdown(socket.SHUT_RD)
+        pool.release('http', host, port, conn)
+        self.assertEqual(self.http.get(self.url, {'url': 'b'}), benchmark.STUB_ARTICLE)
+
+    def test_timeout_not_retried_on_fresh_connection(self):
+        http = PooledHttpHandler(None, {'attempts': 1, 'timeout': 0.2})
+        try:
+            http.get(self.url, {'url': 'a'})
+            start = time.time()
+            self.assertFalse(http.get(self.url, {'url': 'slow-once'}))
+            self.assertTrue(time.time() - start < 0.35)
+            self.assertEqual(benchmark.StubRequestHandler.requests['/api/article?url=slow-once'], 1)
+        finally:
+            http.close()
+            # let the server finish the slow response before it is shut down
+            time.sleep(0.4)
+
+class ArticlesBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.cache_folder = tempfile.mkdtemp()
+        self.diffbot = DiffBot({'handler': 'file', 'cache_folder': self.cache_folder},
+                               dev_token = 'test', http_options = {'handler': 'pool'})
+        self.diffbot.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
+
+    def tearDown(self):
+        self.diffbot.http_handler().close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_folder)
+
+    def test_ordered_results(self):
+        urls = ['http://example.com/%d' % i for i in range(20)]
+        results = list(self.diffbot.articles(urls, max_workers = 4))
+        self.assertEqual([r[0] for r in results], urls)
+        for url, article, error in results:
+            self.assertEqual(error, None)
+            self.assertEqual(article['title'], 'Example')
+
+    def test_unordered_results(self):
+        urls = ['http://example.com/%d' % i for i in range(20)]
+        results = list(self.diffbot.articles(urls, max_workers = 4, ordered = False))
+        self.assertEqual(sorted([r[0] for r in results]), sorted(urls))
+
+    def test_per_url_errors(self):
+        urls = ['http://example.com/ok', 'http://example.com/fail', 'http://example.com/ok2']
+        results = list(self.diffbot.articles(urls))
+        self.assertEqual(results[0][2], None)
+        self.assertTrue(isinstance(results[1][2], Exception))
+        self.assertEqual(results[1][1], None)
+        self.assertEqual(results[2][2], None)
+
+    def test_cache_hits_skip_pool(self):
+        url = 'http://example.com/cached'
+        self.diffbot.article(url)
+        self.server.shutdown()
+        results = list(self.diffbot.articles([url]))
+        self.assertEqual(results[0][2], None)
+        self.assertEqual(results[0][1]['title'], 'Example')
+
+class AsyncDiffBotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.diffbot = AsyncDiffBot(dev_token = 'test', http_options = {'max_concurrency': 5})
+        self.diffbot.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent_articles(self):
+        results = [self.diffbot.article('http://example.com/%d' % i) for i in range(30)]
+        self.assertTrue(self.diffbot.http_handler().pending() > 5)
+        self.diffbot.run()
+        for result in results:
+            self.assertTrue(result.done)
+            self.assertEqual(result.result['title'], 'Example')
+            self.assertEqual(result.result['raw_response'], '')
+
+    def test_wait_and_failure(self):
+        result = self.diffbot.article('http://example.com/fail')
+        self.assertEqual(result.wait(), False)
+        self.assertEqual(self.diffbot.article('http://example.com/ok').wait()['title'], 'Example')
+
+    def test_public_methods(self):
+        db = self.diffbot
+        public = sorted([name for name in dir(db) if not name.startswith('_')
+                         and callable(getattr(db, name))])
+        self.assertEqual(public, ['article', 'cursor_store', 'follow_add', 'follow_read',
+                                  'http_handler', 'run'])
+        article = db.article('http://example.com/public', dirty_hack = True)
+        added = db.follow_add('http://example.com/public')
+        read = db.follow_read(3)
+        changes = db.follow_read(4, changes_only = True)
+        db.run()
+        self.assertEqual(article.result['raw_response'], benchmark.STUB_ARTICLE)
+        self.assertEqual(added.result['id'], '42')
+        self.assertEqual(len(read.result['items']), 3)
+        self.assertEqual(len(changes.result['items']), 4)
+        self.assertEqual(db.follow_read(4, changes_only = True).wait()['items'], [])
+        self.assertEqual(len(db.cursor_store().get(4)), 4)
+        self.assertEqual(db.follow_read('fail').wait(), False)
+
+    def client(self, cache_options):
+        db = AsyncDiffBot(cache_options, dev_token = 'test')
+        db.api_endpoint_base = self.diffbot.api_endpoint_base
+        return db
+
+    def requests(self, name):
+        return sum([count for path, count in benchmark.StubRequestHandler.requests.items()
+                    if name in path])
+
+    def test_negative_cache(self):
+        db = self.client({'handler': 'memory', 'cache_negative_ttl': 60})
+        self.assertEqual(db.article('http://example.com/fail-async').wait(), False)
+        requests = self.requests('fail-async')
+        result = db.article('http://example.com/fail-async')
+        self.assertTrue(result.done)
+        self.assertEqual(result.result, False)
+        self.assertEqual(self.requests('fail-async'), requests)
+        self.assertEqual(db.http_handler().cache_handler().stats()['negative_hits'], 1)
+
+    def test_stale_while_revalidate(self):
+        db = self.client({'handler': 'memory', 'cache_soft_ttl': 0.1})
+        self.assertEqual(db.article('http://example.com/stale-async').wait()['title'], 'Example')
+        time.sleep(0.15)
+        result = db.article('http://example.com/stale-async')
+        self.assertTrue(result.done)
+        self.assertEqual(result.result['title'], 'Example')
+        db.run()
+        self.assertEqual(self.requests('stale-async'), 2)
+        stats = db.http_handler().cache_handler().stats()
+        self.assertEqual((stats['stale'], stats['refreshed']), (1, 1))
+        self.assertTrue(db.article('http://example.com/stale-async').done)
+        db.run()
+        self.assertEqual(self.requests('stale-async'), 2)
+
+class MemoryCacheHandlerTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        memory = MemoryCacheHandler({'memory_max_entries': 2})
+        memory.set('a', '1')
+        memory.set('b', '2')
+        memory.get('a')
+        memory.set('c', '3')
+        self.assertEqual(memory.get('b'), False)
+        self.assertEqual(memory.get('a'), '1')
+        self.assertEqual(memory.get('c'), '3')
+        self.assertEqual(memory.stats()['evictions'], 1)
+
+    def test_byte_bound(self):
+        memory = MemoryCacheHandler({'memory_max_bytes': 10})
+        memory.set('a', 'x' * 6)
+        memory.set('b', 'y' * 6)
+        self.assertEqual(memory.get('a'), False)
+        self.assertEqual(memory.stats()['bytes'], 6)
+        memory.set('c', 'z' * 11)
+        self.assertEqual(memory.get('c'), False)
+
+    def test_ttl(self):
+        memory = MemoryCacheHandler({'memory_ttl': 60})
+        memory.set('a', '1', ttl = -1)
+        memory.set('b', '2')
+        self.assertEqual(memory.get('a'), False)
+        self.assertEqual(memory.get('b'), '2')
+        stats = memory.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expired']), (1, 1, 1))
+
+    def test_two_level(self):
+        folder = tempfile.mkdtemp()
+        try:
+            options = {'handler': 'file', 'cache_folder': folder, 'memory': True}
+            tiered = cache.handler(options)
+            self.assertTrue(isinstance(tiered, MemoryCacheHandler))
+            self.assertTrue(isinstance(tiered.backend, FileCacheHandler))
+            tiered.set('a', '1')
+            self.assertEqual(cache.handler(options).get('a'), '1')
+            self.assertEqual(tiered.get('a'), '1')
+            self.assertEqual(tiered.stats()['hits'], 1)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_threads(self):
+        memory = MemoryCacheHandler({'memory_max_entries': 50})
+        def work(n):
+            for i in range(500):
+                memory.set('%d-%d' % (n, i % 100), 'x')
+                memory.get('%d-%d' % (n, i % 70))
+        threads = [threading.Thread(target = work, args = (n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(memory.stats()['entries'], 50)
+        self.assertEqual(memory.stats()['bytes'], 50)
+
+class FakeMemcacheClient(object):
+    """In-process stand-in for a python-memcached Client"""
+
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        value, expires = self.data.get(key, (None, 0))
+        if expires and expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl = 0):
+        self.calls += 1
+        self.data[key] = (value, ttl and time.time() + ttl)
+        return True
+
+    def get_multi(self, keys, key_prefix = ''):
+        self.calls += 1
+        values = {}
+        for key in keys:
+            value, expires = self.data.get(key_prefix + key, (None, 0))
+            if value is not None and not (expires and expires < time.time()):
+                values[key] = value
+        return values
+
+    def set_multi(self, mapping, ttl = 0, key_prefix = ''):
+        self.calls += 1
+        for key, value in mapping.items():
+            self.data[key_prefix + key] = (value, ttl and time.time() + ttl)
+        return []
+
+
+class MemcacheHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeMemcacheClient()
+        self.memcache = cache.handler({'handler': 'memcache', 'memcache_client': self.client,
+                                       'memcache_ttl': 60, 'memcache_prefix': 'db:'})
+
+    def test_get_set(self):
+        self.assertTrue(isinstance(self.memcache, MemcacheHandler))
+        self.assertEqual(self.memcache.get('a'), False)
+        self.assertTrue(self.memcache.set('a', '1'))
+        self.assertEqual(self.memcache.get('a'), '1')
+        self.assertTrue(self.client.data.has_key('db:a'))
+
+    def test_ttl(self):
+        self.memcache.set('a', '1')
+        self.assertTrue(self.client.data['db:a'][1] > time.time() + 50)
+        self.memcache.ttl = -1
+        self.memcache.set('b', '2')
+        self.assertEqual(self.memcache.get('b'), False)
+
+    def test_multi(self):
+        self.assertEqual(self.memcache.set_multi({'a': '1', 'b': '2'}), [])
+        self.client.calls = 0
+        self.assertEqual(self.memcache.get_multi(['a', 'b', 'c']), {'a': '1', 'b': '2'})
+        self.assertEqual(self.client.calls, 1)
+
+    def test_memory_tier_multi(self):
+        tiered = MemoryCacheHandler(None, self.memcache)
+        tiered.set('a', '1')
+        self.memcache.set('b', '2')
+        self.client.calls = 0
+        self.assertEqual(tiered.get_multi(['a', 'b']), {'a': '1', 'b': '2'})
+        self.assertEqual(self.client.calls, 1)
+        self.assertEqual(tiered.get_multi(['a', 'b']), {'a': '1', 'b': '2'})
+        self.assertEqual(self.client.calls, 1)
+
+class FakePymemcacheClient(object):
+    """In-process stand-in for a pymemcache client"""
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.memcache = FakeMemcacheClient()
+        self.data = self.memcache.data
+
+    def get(self, key):
+        return self.memcache.get(key)
+
+    def set(self, key, value, expire = 0):
+        return self.memcache.set(key, value, expire)
+
+    def get_many(self, keys):
+        return self.memcache.get_multi(keys)
+
+    def set_many(self, values, expire = 0):
+        return self.memcache.set_multi(values, expire)
+
+class PymemcacheHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        import sys, types
+
+        self.saved_modules = dict(cache.compat._modules)
+        self.saved_sys_modules = dict(sys.modules)
+        for name in ('pymemcache', 'pymemcache.client', 'pymemcache.client.base',
+                     'pymemcache.client.hash'):
+            sys.modules[name] = types.ModuleType(name)
+        sys.modules['pymemcache.client.base'].PooledClient = FakePymemcacheClient
+        sys.modules['pymemcache.client.hash'].HashClient = FakePymemcacheClient
+        cache.compat._modules['memcache'] = None
+        cache.compat._modules.pop('pymemcache.client.hash', None)
+
+    def tearDown(self):
+        import sys
+
+        cache.compat._modules.clear()
+        cache.compat._modules.update(self.saved_modules)
+        sys.modules.clear()
+        sys.modules.update(self.saved_sys_modules)
+
+    def test_pymemcache_client(self):
+        memcache = cache.handler({'handler': 'memcache', 'memcache_server': 'mc1:11212',
+                                  'memcache_prefix': 'db:'})
+        self.assertTrue(isinstance(memcache, MemcacheHandler))
+        self.assertTrue(isinstance(memcache.client, FakePymemcacheClient))
+        self.assertEqual(memcache.client.args, (('mc1', 11212),))
+        self.assertEqual(memcache.set_multi({'a': '1', 'b': '2'}), [])
+        self.assertTrue(memcache.client.data.has_key('db:a'))
+        self.assertEqual(memcache.get_multi(['a', 'b', 'c']), {'a': '1', 'b': '2'})
+        self.assertEqual(memcache.get('b'), '2')
+
+    def test_hash_client_for_several_servers(self):
+        memcache = cache.handler({'memcache_server': 'mc1, mc2:11212'})
+        self.assertEqual(memcache.client.args, ([('mc1', 11211), ('mc2', 11212)],))
+
+    def test_no_client_library(self):
+        cache.compat._modules['pymemcache.client.hash'] = None
+        self.assertRaises(Exception, cache.handler,
+                          {'handler': 'memcache', 'memcache_server': '127.0.0.1:11211'})
+
+class FileCacheHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def handler(self, **options):
+        options['cache_folder'] = self.folder
+        return FileCacheHandler(options)
+
+    def test_sharded_atomic_write(self):
+        files = self.handler()
+        key = files.hash('http://example.com/')
+        self.assertTrue(files.set(key, 'value'))
+        path = files.get_filepath(key)
+        self.assertEqual(len(os.path.relpath(path, self.folder).split(os.sep)), 3)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [key + '.txt'])
+        self.assertEqual(files.get(key), 'value')
+
+    def test_ttl(self):
+        files = self.handler(cache_ttl = 60)
+        key = files.hash('a')
+        files.set(key, 'value')
+        self.assertEqual(files.get(key), 'value')
+        old = time.time() - 120
+        os.utime(files.get_filepath(key), (old, old))
+        self.assertEqual(files.get(key), False)
+        self.assertFalse(os.path.exists(files.get_filepath(key)))
+
+    def test_collect_max_size(self):
+        writer = self.handler()
+        keys = [writer.hash(str(i)) for i in range(5)]
+        for i, key in enumerate(keys):
+            writer.set(key, 'x' * 10)
+            os.utime(writer.get_filepath(key), (1000 + i, 1000 + i))
+        open(os.path.join(self.folder, 'unrelated.txt'), 'w').write('keep')
+        files = self.handler(cache_max_size = 25)
+        self.assertEqual(files.collect(), 3)
+        self.assertEqual([bool(files.get(key)) for key in keys], [False, False, False, True, True])
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'unrelated.txt')))
+
+    def test_background_collect(self):
+        files = self.handler(cache_max_size = 0, cache_gc_interval = 2)
+        keys = [files.hash(str(i)) for i in range(2)]
+        for key in keys:
+            files.set(key, 'x')
+        for i in range(50):
+            if not files._gc_running:
+                break
+            time.sleep(0.01)
+        self.assertEqual([files.get(key) for key in keys], [False, False])
+
+    def wait_gc(self, files):
+        for i in range(100):
+            if not files._gc_running:
+                return
+            time.sleep(0.01)
+
+    def test_collect_only_over_max_size(self):
+        files = self.handler(cache_max_size = 1000)
+        scans = []
+        collect = files.collect
+        files.collect = lambda: scans.append(1) or collect()
+        for i in range(50):
+            files.set(files.hash(str(i)), 'x' * 10)
+            self.wait_gc(files)
+        # the first write sizes the cache, and the rest stay under max_size
+        self.assertEqual(len(scans), 1)
+        for i in range(50, 56):
+            files.set(files.hash(str(i)), 'x' * 100)
+            self.wait_gc(files)
+        self.assertEqual(len(scans), 2)
+        self.assertTrue(files._size <= 900)
+
+    def test_ttl_collect_interval(self):
+        files = self.handler(cache_ttl = 60, cache_gc_interval = 3600)
+        scans = []
+        files.collect = lambda: scans.append(1)
+        for i in range(20):
+            files.set(files.hash(str(i)), 'x')
+        self.assertEqual(scans, [])
+        files._last_gc -= 3600
+        files.set(files.hash('due'), 'x')
+        self.wait_gc(files)
+        self.assertEqual(scans, [1])
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeMemcacheClient()
+        self.value = '{"text": "%s"}' % ('article text ' * 500)
+
+    def handler(self, **options):
+        options['memcache_client'] = self.client
+        return MemcacheHandler(options)
+
+    def test_round_trip(self):
+        for codec in ['zlib', 'bz2']:
+            memcache = self.handler(cache_compress = codec, cache_compress_level = 9)
+            memcache.set('a', self.value)
+            self.assertTrue(len(self.client.data['a'][0]) < len(self.value) / 10)
+            self.assertEqual(memcache.get('a'), self.value)
+            self.assertEqual(memcache.get_multi(['a']), {'a': self.value})
+            self.assertTrue(memcache.stats()['compression_ratio'] > 10)
+
+    def test_threshold(self):
+        memcache = self.handler(cache_compress = 'zlib', cache_compress_threshold = 100)
+        memcache.set('a', 'short')
+        self.assertEqual(self.client.data['a'][0], 'short')
+        self.assertEqual(memcache.get('a'), 'short')
+        self.assertEqual(memcache.stats()['compression_ratio'], 1.0)
+
+    def test_reads_uncompressed_entries(self):
+        self.handler().set('a', self.value)
+        self.assertEqual(self.handler(cache_compress = 'zlib').get('a'), self.value)
+
+    def test_file_cache(self):
+        folder = tempfile.mkdtemp()
+        try:
+            files = FileCacheHandler({'cache_folder': folder, 'cache_compress': 'zlib'})
+            files.set(files.hash('a'), self.value)
+            self.assertTrue(os.path.getsize(files.get_filepath(files.hash('a'))) < len(self.value))
+            self.assertEqual(files.get(files.hash('a')), self.value)
+        finally:
+            shutil.rmtree(folder)
+
+class SqliteCacheHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.options = {'handler': 'sqlite', 'sqlite_path': os.path.join(self.folder, 'cache.db'),
+                        'sqlite_batch_size': 3, 'sqlite_flush_interval': 60}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_batched_writes(self):
+        sqlite = cache.handler(self.options)
+        self.assertTrue(isinstance(sqlite, SqliteCacheHandler))
+        other = cache.handler(self.options)
+        sqlite.set('a', '1')
+        sqlite.set('b', '2')
+        self.assertEqual(sqlite.get('a'), '1')
+        self.assertEqual(other.get('a'), False)
+        sqlite.set('c', '3')
+        self.assertEqual(other.get_multi(['a', 'b', 'c', 'd']), {'a': '1', 'b': '2', 'c': '3'})
+
+    def test_ttl_and_purge(self):
+        self.options['sqlite_ttl'] = -1
+        sqlite = cache.handler(self.options)
+        sqlite.set_multi({'a': '1', 'b': '2', 'c': '3'})
+        self.assertEqual(sqlite.get('a'), False)
+        self.assertEqual(sqlite.purge(), 3)
+
+    def test_wal_and_threads(self):
+        sqlite = cache.handler(self.options)
+        mode = sqlite._db().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+        def work(n):
+            for i in range(20):
+                sqlite.set('%d-%d' % (n, i), 'x')
+            sqlite.flush()
+        threads = [threading.Thread(target = work, args = (n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        keys = ['%d-%d' % (n, i) for n in range(4) for i in range(20)]
+        self.assertEqual(len(cache.handler(self.options).get_multi(keys)), 80)
+
+    def test_flush_interval_without_later_writes(self):
+        self.options['sqlite_flush_interval'] = 0.1
+        sqlite = cache.handler(self.options)
+        other = cache.handler(self.options)
+        sqlite.set('a', '1')
+        self.assertEqual(other.get('a'), False)
+        deadline = time.time() + 2
+        while not other.get('a') and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(other.get('a'), '1')
+
+    def test_flush_joins_timer(self):
+        sqlite = cache.handler(self.options)
+        sqlite.set('a', '1')
+        timer = sqlite._timer
+        self.assertTrue(timer.is_alive())
+        sqlite.flush()
+        self.assertFalse(timer.is_alive())
+        self.assertEqual(sqlite._timer, None)
+
+    def test_handlers_can_be_collected(self):
+        import gc, weakref
+
+        sqlite = cache.handler(self.options)
+        sqlite.set_multi({'a': '1', 'b': '2', 'c': '3'})
+        ref = weakref.ref(sqlite)
+        del sqlite
+        gc.collect()
+        self.assertEqual(ref(), None)
+
+class CoalescingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def slow_fetch(self, url, data):
+        self.lock.acquire()
+        self.calls += 1
+        self.lock.release()
+        time.sleep(0.2)
+        return 'response for %s' % data['url']
+
+    def run_threads(self, fetch, count = 10):
+        results = []
+        def work():
+            results.append(fetch('http://api/', {'url': 'hot'}))
+        threads = [threading.Thread(target = work) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_misses_share_one_call(self):
+        for handler in [cache.NullHandler(None), MemoryCacheHandler(None)]:
+            self.calls = 0
+            results = self.run_threads(handler.wrap(self.slow_fetch))
+            self.assertEqual(self.calls, 1)
+            self.assertEqual(results, ['response for hot'] * 10)
+            self.assertEqual(handler.stats()['coalesced'], 9)
+
+    def test_errors_are_shared(self):
+        def failing_fetch(url, data):
+            time.sleep(0.1)
+            raise IOError('upstream failed')
+        errors = []
+        fetch = cache.NullHandler(None).wrap(failing_fetch)
+        def work():
+            try:
+                fetch('http://api/', {'url': 'hot'})
+            except IOError, e:
+                errors.append(e)
+        threads = [threading.Thread(target = work) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 5)
+
+    def test_async_coalescing(self):
+        server = benchmark.start_server()
+        try:
+            db = AsyncDiffBot(dev_token = 'test')
+            db.api_endpoint_base = 'http://%s:%d/api/' % server.server_address
+            results = [db.article('http://example.com/hot') for i in range(5)]
+            self.assertEqual(db.http_handler().pending(), 1)
+            db.run()
+            self.assertEqual([r.result['title'] for r in results], ['Example'] * 5)
+            self.assertEqual(db.http_handler().cache_handler().stats()['coalesced'], 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class ParsedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def client(self, cache_options):
+        db = DiffBot(cache_options, dev_token = 'test')
+        db.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
+        return db
+
+    def test_hits_skip_json(self):
+        import diffbot as diffbot_module
+        for options in [{'handler': 'memory', 'cache_parsed': True},
+                        {'handler': 'file', 'cache_folder': self.folder, 'cache_parsed': True}]:
+            url = 'http://example.com/%s' % options['handler']
+            expected = self.client(None).article(url)
+            db = self.client(options)
+            self.assertEqual(db.article(url), expected)
+            json_module = diffbot_module.json
+            diffbot_module.json = None
+            try:
+                self.assertEqual(db.article(url), expected)
+                self.assertEqual(list(db.articles([url]))[0][1], expected)
+                if options['handler'] == 'file':
+                    self.assertEqual(self.client(options).article(url), expected)
+            finally:
+                diffbot_module.json = json_module
+
+    def test_hits_are_copies(self):
+        db = self.client({'handler': 'memory', 'cache_parsed': True})
+        db.article('http://example.com/')['title'] = 'changed'
+        self.assertEqual(db.article('http://example.com/')['title'], 'Example')
+
+    def test_nested_values_are_copies(self):
+        db = self.client({'handler': 'memory', 'cache_parsed': True})
+        db.article('http://example.com/')['tags'].append('first')
+        db.article('http://example.com/')['tags'].append('hit')
+        self.assertEqual(db.article('http://example.com/')['tags'], [])
+
+    def test_dirty_hack_keeps_raw_response(self):
+        db = self.client({'handler': 'memory', 'cache_parsed': True})
+        db.article('http://example.com/')
+        article = db.article('http://example.com/', dirty_hack = True)
+        self.assertEqual(article['raw_response'], benchmark.STUB_ARTICLE)
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(50, burst = 5)
+        start = time.time()
+        for i in range(15):
+            limiter.acquire()
+        elapsed = time.time() - start
+        self.assertTrue(0.15 < elapsed < 0.5, elapsed)
+
+    def test_shared_file(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'bucket')
+            first = RateLimiter(50, burst = 5, path = path)
+            second = RateLimiter(50, burst = 5, path = path)
+            start = time.time()
+            for i in range(5):
+                first.acquire()
+                second.acquire()
+            elapsed = time.time() - start
+            self.assertTrue(elapsed > 0.07, elapsed)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_adaptive_concurrency(self):
+        limiter = AdaptiveConcurrency(8, backoff_interval = 0)
+        limiter.acquire()
+        limiter.release(429)
+        self.assertEqual(limiter.limit, 4)
+        limiter.acquire()
+        limiter.release(503)
+        self.assertEqual(limiter.limit, 2)
+        limiter.acquire()
+        limiter.release(404)
+        self.assertEqual(limiter.limit, 2)
+        for i in range(2):
+            limiter.acquire()
+            limiter.release(200)
+        self.assertEqual(limiter.limit, 3)
+
+    def test_handler_backs_off(self):
+        server = benchmark.start_server()
+        try:
+            url = 'http://%s:%d/api/article' % server.server_address
+            http = PooledHttpHandler(None, {'adaptive_concurrency': 8, 'rate_limit': 1000,
+                                            'attempts': 1})
+            self.assertEqual(http.get(url, {'url': 'fail'}), False)
+            self.assertEqual(http._concurrency.limit, 4)
+            self.assertEqual(http._concurrency.in_flight, 0)
+            self.assertEqual(http.get(url, {'url': 'ok'}), benchmark.STUB_ARTICLE)
+            http.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.url = 'http://%s:%d/api/article' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retries_transient_errors(self):
+        for handler_class in [PooledHttpHandler, Urllib2Handler]:
+            http = handler_class(None, {'attempts': 3, 'retry_backoff': 0.01})
+            data = {'url': 'flaky-%s' % handler_class.__name__}
+            self.assertEqual(http.get(self.url, data), benchmark.STUB_ARTICLE)
+            http.close()
+
+    def test_gives_up_after_attempts(self):
+        http = PooledHttpHandler(None, {'attempts': 2, 'retry_backoff': 0.01})
+        self.assertEqual(http.get(self.url, {'url': 'flaky'}), False)
+        http.close()
+
+    def test_attempt_timeout_and_deadline(self):
+        http = PooledHttpHandler(None, {'attempts': 10, 'retry_backoff': 0.01,
+                                        'timeout': 0.1, 'deadline': 0.35})
+        start = time.time()
+        self.assertEqual(http.get(self.url, {'url': 'slow'}), False)
+        self.assertTrue(time.time() - start < 0.5)
+        http.close()
+
+    def test_backoff(self):
+        from handlers import RetryPolicy
+        policy = RetryPolicy(backoff = 1, max_backoff = 3, jitter = False)
+        start = time.time()
+        self.assertEqual([policy.delay(n, start) for n in range(1, 5)], [1, 2, 3, 3])
+        policy.deadline = 2.5
+        self.assertEqual(policy.delay(3, start), None)
+        self.assertTrue(0 <= RetryPolicy(backoff = 1).delay(2, start) <= 2)
+
+class FollowReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.diffbot = DiffBot(dev_token = 'test')
+        self.diffbot.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_follow_add(self):
+        add_info = self.diffbot.follow_add('http://www.example.com/')
+        self.assertEqual(add_info, {'id': '42', 'new': 'true', 'title': 'Example',
+                                    'pubDate': 'Thu, 07 Apr 2011 10:00:00 GMT'})
+
+    def test_follow_read(self):
+        read_info = self.diffbot.follow_read(3)
+        self.assertEqual(read_info['info'], {'id': '3', 'new': 'true', 'title': 'Example',
+                                             'link': 'http://www.example.com/'})
+        self.assertEqual(len(read_info['items']), 3)
+        self.assertEqual(read_info['items'][1], {'id': '1', 'hash': 'h1', 'title': 'Item 1',
+                                                 'link': 'http://www.example.com/1',
+                                                 'pubDate': 'Thu, 07 Apr 2011 10:00:00 GMT'})
+
+    def test_follow_read_iter(self):
+        info = {}
+        items = self.diffbot.follow_read_iter(500, info)
+        self.assertEqual(items.next()['id'], '0')
+        self.assertEqual(info['id'], '500')
+        self.assertEqual(len(list(items)), 499)
+        self.assertEqual(list(self.diffbot.follow_read_iter(3)), self.diffbot.follow_read(3)['items'])
+
+    def test_changes_only(self):
+        self.assertEqual(len(self.diffbot.follow_read(5, changes_only = True)['items']), 5)
+        self.assertEqual(self.diffbot.follow_read(5, changes_only = True)['items'], [])
+        self.assertEqual(list(self.diffbot.follow_read_iter(5, changes_only = True)), [])
+        store = self.diffbot.cursor_store()
+        cursor = dict(store.get(5))
+        cursor['1'] = 'old'
+        del cursor['3']
+        store.set(5, cursor)
+        items = self.diffbot.follow_read(5, changes_only = True)['items']
+        self.assertEqual([item['id'] for item in items], ['1', '3'])
+        self.assertEqual(len(self.diffbot.follow_read(6, changes_only = True)['items']), 6)
+
+    def test_changes_only_without_ids(self):
+        items = [{'title': 'Item %d' % i} for i in range(3)]
+        self.assertEqual(list(self.diffbot._changes('anonymous', iter(items))), items)
+        self.assertEqual(list(self.diffbot._changes('anonymous', iter(items))), [])
+        changed = items[:2] + [{'title': 'Item 3'}]
+        self.assertEqual(list(self.diffbot._changes('anonymous', iter(changed))), [changed[2]])
+
+    def test_persistent_cursor(self):
+        folder = tempfile.mkdtemp()
+        try:
+            options = {'handler': 'sqlite', 'sqlite_path': os.path.join(folder, 'cache.db')}
+            for expected in [3, 0]:
+                db = DiffBot(options, dev_token = 'test')
+                db.api_endpoint_base = self.diffbot.api_endpoint_base
+                items = list(db.follow_read_iter(3, changes_only = True))
+                self.assertEqual(len(items), expected)
+                db.http_handler().cache_handler().flush()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_errors(self):
+        self.assertRaises(DiffBotError, list, self.diffbot.follow_read_iter('fail'))
+
+    def test_follow_add_many(self):
+        results = self.diffbot.follow_add_many(['http://www.example.com/%d' % i for i in range(10)])
+        self.assertEqual(len(results), 10)
+        for add_info, error in results.values():
+            self.assertEqual(error, None)
+            self.assertEqual(add_info['id'], '42')
+
+    def test_follow_read_many(self):
+        results = self.diffbot.follow_read_many([1, 2, 3, 'fail'], max_workers = 2)
+        self.assertEqual(sorted(results.keys()), [1, 2, 3, 'fail'])
+        for follow_id in (1, 2, 3):
+            read_info, error = results[follow_id]
+            self.assertEqual(error, None)
+            self.assertEqual(read_info, self.diffbot.follow_read(follow_id))
+        read_info, error = results['fail']
+        self.assertEqual(read_info, None)
+        self.assertTrue(isinstance(error, DiffBotError))
+
+    def streaming_client(self):
+        db = DiffBot({'handler': 'memory'}, dev_token = 'test',
+                     http_options = {'handler': 'pool', 'stream': True})
+        db.api_endpoint_base = self.diffbot.api_endpoint_base
+        return db
+
+    def test_follow_read_iter_streaming(self):
+        db = self.streaming_client()
+        info = {}
+        items = db.follow_read_iter(300, info)
+        self.assertEqual(items.next()['id'], '0')
+        self.assertEqual(info['id'], '300')
+        self.assertEqual(len(list(items)), 299)
+        self.assertEqual(list(db.follow_read_iter(3)), self.diffbot.follow_read(3)['items'])
+        self.assertRaises(DiffBotError, list, db.follow_read_iter('fail'))
+        db.http_handler().close()
+
+    def test_streaming_stops_when_closed(self):
+        db = self.streaming_client()
+        threads = threading.active_count()
+        items = db.follow_read_iter(5000)
+        items.next()
+        items.close()
+        deadline = time.time() + 2
+        while threading.active_count() > threads and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(threading.active_count(), threads)
+        db.http_handler().close()
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.url = 'http://%s:%d/api/article' % self.server.server_address
+        self.http = PooledHttpHandler(None, {'stream': True})
+
+    def tearDown(self):
+        self.http.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_load_gets_file(self):
+        loaded = []
+        def load(fh):
+            loaded.append(fh.read())
+            return 'loaded'
+        self.assertEqual(self.http.get(self.url, {'url': 'a'}, parse = str, load = load), 'loaded')
+        self.assertEqual(loaded, [benchmark.STUB_ARTICLE])
+
+    def test_connection_reuse(self):
+        self.http.get(self.url, {'url': 'a'}, parse = str, load = lambda fh: fh.read(1))
+        host, port = self.server.server_address
+        pool = self.http.connection_pool()
+        conn, reused = pool.acquire('http', host, port)
+        self.assertTrue(reused)
+        pool.release('http', host, port, conn)
+        self.assertEqual(self.http.get(self.url, {'url': 'b'}), benchmark.STUB_ARTICLE)
+
+    def test_article_matches_buffered(self):
+        base = 'http://%s:%d/api/' % self.server.server_address
+        articles = []
+        for options in ({'handler': 'pool'}, {'handler': 'pool', 'stream': True}):
+            db = DiffBot(dev_token = 'test', http_options = options)
+            db.api_endpoint_base = base
+            articles.append(db.article('http://www.example.com/'))
+            db.http_handler().close()
+        self.assertEqual(articles[0], articles[1])
+        self.assertEqual(articles[1]['raw_response'], '')
+
+    def test_keep_raw_response(self):
+        for options in (None, {'handler': 'memory'}, {'handler': 'memory', 'cache_parsed': True}):
+            db = DiffBot(options, dev_token = 'test', keep_raw_response = False)
+            db.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
+            url = 'http://www.example.com/'
+            self.assertEqual(db.article(url, dirty_hack = True)['raw_response'], '')
+            url, article, error = list(db.articles([url], dirty_hack = True))[0]
+            self.assertEqual(article['raw_response'], '')
+            db.http_handler().close()
+
+class LoadArticleTest(unittest.TestCase):
+
+    response = '{"title": "A", "text": "body", "stats": {"fetchTime": 12, "confidence": 0.5}, ' \
+               '"media": [{"width": 640}]}'
+
+    def setUp(self):
+        self.saved_modules = dict(cache.compat._modules)
+
+    def tearDown(self):
+        cache.compat._modules.clear()
+        cache.compat._modules.update(self.saved_modules)
+
+    def load(self):
+        from StringIO import StringIO
+
+        return load_article(StringIO(self.response))
+
+    def test_json(self):
+        cache.compat._modules['ijson'] = None
+        article = self.load()
+        self.assertEqual(article['title'], 'A')
+        self.assertEqual(article['tags'], [])
+        self.assertEqual(article['stats'], {'fetchTime': 12, 'confidence': 0.5})
+
+    def test_ijson_numbers_are_undecimaled(self):
+        import types, json, decimal
+
+        ijson = types.ModuleType('ijson')
+        ijson.items = lambda fh, prefix: iter([json.load(fh, parse_int = decimal.Decimal,
+                                                         parse_float = decimal.Decimal)])
+        cache.compat._modules['ijson'] = ijson
+        article = self.load()
+        self.assertEqual(article['stats'], {'fetchTime': 12, 'confidence': 0.5})
+        self.assertTrue(isinstance(article['stats']['fetchTime'], int))
+        self.assertTrue(isinstance(article['stats']['confidence'], float))
+        self.assertTrue(isinstance(article['media'][0]['width'], int))
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.base = 'http://%s:%d/api/' % self.server.server_address
+        self.sink = MemorySink()
+        self.metrics = Metrics([self.sink])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_memory_sink(self):
+        for i in range(1, 101):
+            self.metrics.timing('t', i / 1000.0)
+        self.metrics.incr('c', 2)
+        self.metrics.adjust('g', 3)
+        self.metrics.adjust('g', -1)
+        snapshot = self.sink.snapshot()
+        self.assertEqual(snapshot['counters'], {'c': 2})
+        self.assertEqual(snapshot['gauges'], {'g': 2})
+        timing = snapshot['timings']['t']
+        self.assertEqual(timing['count'], 100)
+        self.assertEqual((timing['min'], timing['p50'], timing['p99'], timing['max']),
+                         (0.001, 0.05, 0.099, 0.1))
+
+    def test_statsd_and_callback_sinks(self):
+        import socket
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        calls = []
+        statsd = StatsdSink(*server.getsockname())
+        metrics = Metrics([statsd, CallbackSink(lambda *args: calls.append(args))])
+        metrics.incr('hits')
+        metrics.timing('lookup', 0.25)
+        self.assertEqual(server.recv(512), 'diffbot.hits:1|c')
+        self.assertEqual(server.recv(512), 'diffbot.lookup:250.000|ms')
+        self.assertEqual(calls, [('counter', 'hits', 1), ('timing', 'lookup', 0.25)])
+        statsd.close()
+        server.close()
+
+    def test_client_instrumented(self):
+        db = DiffBot({'handler': 'memory'}, dev_token = 'test', metrics = self.metrics,
+                     http_options = {'handler': 'pool'})
+        db.api_endpoint_base = self.base
+        db.article('http://www.example.com/')
+        db.article('http://www.example.com/')
+        db.http_handler().close()
+        snapshot = self.sink.snapshot()
+        self.assertEqual(snapshot['counters']['cache.hit'], 1)
+        self.assertEqual(snapshot['counters']['cache.miss'], 1)
+        self.assertEqual(snapshot['counters']['http.bytes'], len(benchmark.STUB_ARTICLE))
+        self.assertEqual(snapshot['gauges']['http.in_flight'], 0)
+        self.assertEqual(snapshot['gauges']['cache.hit_ratio'], 0.5)
+        for name in ('diffbot.article', 'cache.lookup', 'http.request', 'http.connect',
+                     'http.wait', 'http.transfer', 'parse.parse_article'):
+            self.assertTrue(snapshot['timings'].has_key(name), name)
+        self.assertEqual(snapshot['timings']['diffbot.article']['count'], 2)
+
+    def test_retries_counted(self):
+        db = DiffBot(dev_token = 'test', metrics = self.metrics,
+                     http_options = {'retry_backoff': 0})
+        db.api_endpoint_base = self.base + 'flaky-metrics/'
+        self.assertTrue(db.article('http://www.example.com/'))
+        counters = self.sink.snapshot()['counters']
+        self.assertEqual((counters['http.retries'], counters['http.errors']), (2, 2))
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_server_options(self):
+        import json
+        server = benchmark.start_server(payload_size = 5000, error_rate = 0.5, seed = 1,
+                                        fixtures = {'follow_add': '<response id="7"/>'})
+        url = 'http://%s:%d/api/' % server.server_address
+        http = PooledHttpHandler(None, {'attempts': 1})
+        try:
+            articles = [http.get(url + 'article', {'url': str(i)}) for i in range(20)]
+            self.assertTrue(0 < articles.count(False) < 20)
+            article = json.loads([a for a in articles if a][0])
+            self.assertTrue(4900 < len(json.dumps(article)) <= 5000)
+            self.assertEqual(article['title'], 'Example')
+            added = [http.post(url + 'add', {'url': str(i)}) for i in range(10)]
+            self.assertTrue('<response id="7"/>' in added)
+        finally:
+            http.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_run_scenario(self):
+        server = benchmark.start_server()
+        url = 'http://%s:%d/api/' % server.server_address
+        try:
+            for mode in benchmark.MODES:
+                result = benchmark.run_scenario(url, 'follow_read', 'pool', 'memory', mode,
+                                                requests = 20, workers = 4, distinct = 5)
+                self.assertEqual((result['requests'], result['errors']), (20, 0))
+                self.assertTrue(result['throughput'] > 0)
+                self.assertTrue(result['p99_ms'] >= result['p50_ms'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_run_isolated(self):
+        server = benchmark.start_server()
+        url = 'http://%s:%d/api/' % server.server_address
+        try:
+            result = benchmark.run_isolated(url, 'article', 'pool', 'memory', 'serial',
+                                            requests = 10)
+            self.assertEqual((result['requests'], result['errors']), (10, 0))
+            self.assertTrue(result['max_rss_kb'] > result['rss_growth_kb'] >= 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.diffbot = DiffBot(dev_token = 'test', attempts = 1, http_options = {'handler': 'pool'})
+        self.diffbot.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
+
+    def tearDown(self):
+        self.diffbot.http_handler().close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batch(self):
+        import json
+        from StringIO import StringIO
+        from diffbot import batch, read_urls
+        lines = StringIO('# urls\nhttp://www.example.com/1\n\nhttp://www.example.com/fail\n'
+                         'http://www.example.com/2\n')
+        out, err = StringIO(), StringIO()
+        self.assertEqual(batch(self.diffbot, read_urls(lines), 2, out, err), 1)
+        records = dict((r['url'], r) for r in map(json.loads, out.getvalue().splitlines()))
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records['http://www.example.com/1']['article']['title'], 'Example')
+        self.assertTrue(records['http://www.example.com/fail']['error'])
+        self.assertTrue(err.getvalue().startswith('3 urls, 1 errors in '))
+
+class CompatTest(unittest.TestCase):
+
+    def test_probes_cached(self):
+        import compat
+        self.assertEqual(compat.module('no_such_module_here'), None)
+        self.assertTrue(compat._modules.has_key('no_such_module_here'))
+        self.assertTrue(hasattr(compat.etree(), 'iterparse'))
+        capabilities = compat.capabilities()
+        self.assertEqual(capabilities['gae'], False)
+        self.assertTrue(capabilities['etree'])
+
+    def test_import_is_lazy(self):
+        import subprocess, sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = ("import sys; import diffbot; print ' '.join(m for m in "
+                  "('urllib', 'decimal', 'xml.etree.ElementTree', 'diffbot.cache', "
+                  "'diffbot.handlers', 'socket') if m in sys.modules)")
+        output = subprocess.Popen([sys.executable, '-c', script], cwd = root,
+                                  stdout = subprocess.PIPE).communicate()[0]
+        self.assertEqual(output.strip(), '')
+
+    def test_first_client_is_lazy(self):
+        import subprocess, sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = ("import sys, diffbot; diffbot.DiffBot(dev_token = 'x'); "
+                  "print ' '.join(m for m in ('sqlite3', 'zlib', 'bz2', 'marshal', "
+                  "'asyncore', 'httplib', 'urllib', 'ssl', 'tempfile') if m in sys.modules)")
+        output = subprocess.Popen([sys.executable, '-c', script], cwd = root,
+                                  stdout = subprocess.PIPE).communicate()[0]
+        self.assertEqual(output.strip(), '')
+
+def title_of(url, article_info):
+    return article_info['title'].upper()
+
+def words_of(url, article_info):
+    # generators can not be pickled back to the parent
+    return (word for word in article_info['text'].split())
+
+def crash_on(url, article_info):
+    if 'crash' in url:
+        os._exit(1)
+    return article_info['title']
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.base = 'http://%s:%d/api/' % self.server.server_address
+        self.folder = tempfile.mkdtemp()
+        self.urls = ['http://www.example.com/pipeline/%d' % i for i in range(20)]
+        self.urls.insert(7, 'http://www.example.com/fail')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def pipeline(self, **kwargs):
+        from pipeline import Pipeline
+        cache_options = {'handler': 'sqlite', 'sqlite_path': os.path.join(self.folder, 'cache.db')}
+        return Pipeline(cache_options, dev_token = 'test', http_options = {'attempts': 1},
+                        processes = 2, threads = 2, chunk_size = 3,
+                        api_endpoint_base = self.base, **kwargs)
+
+    def test_ordered_jsonl(self):
+        import json
+        from pipeline import JsonlSink
+        path = os.path.join(self.folder, 'out.jsonl')
+        summary = self.pipeline().run(self.urls, JsonlSink(path))
+        self.assertEqual((summary['count'], summary['errors']), (21, 1))
+        records = [json.loads(line) for line in open(path)]
+        self.assertEqual([r['url'] for r in records], self.urls)
+        self.assertTrue(records[7]['error'])
+        self.assertEqual(records[0]['article']['title'], 'Example')
+
+    def test_unordered_sqlite_shared_cache(self):
+        import sqlite3
+        from pipeline import SqliteSink
+        path = os.path.join(self.folder, 'out.db')
+        pipeline = self.pipeline(process = title_of)
+        pipeline.run(self.urls, SqliteSink(path), ordered = False)
+        requests = sum(benchmark.StubRequestHandler.requests.values())
+        results = sorted(pipeline.imap(self.urls, ordered = False))
+        # the second run is answered from the cache the workers share
+        self.assertEqual(sum(benchmark.StubRequestHandler.requests.values()), requests + 1)
+        self.assertEqual(results[0], ('http://www.example.com/fail', None, results[0][2]))
+        self.assertEqual(results[1], ('http://www.example.com/pipeline/0', 'EXAMPLE', None))
+        db = sqlite3.connect(path)
+        rows = db.execute('SELECT url, result, error FROM articles').fetchall()
+        self.assertEqual(len(rows), 21)
+        self.assertEqual(len([row for row in rows if row[2]]), 1)
+
+    def test_unpicklable_results(self):
+        results = list(self.pipeline(process = words_of).imap(self.urls))
+        self.assertEqual([r[0] for r in results], self.urls)
+        self.assertTrue(all([error for url, result, error in results]))
+
+    def test_worker_death(self):
+        urls = self.urls[:]
+        urls.insert(12, 'http://www.example.com/crash')
+        results = list(self.pipeline(process = crash_on).imap(urls))
+        self.assertEqual([r[0] for r in results], urls)
+        self.assertTrue(results[12][2])
+        self.assertEqual(results[-1], (urls[-1], 'Example', None))
+
+class CacheWarmerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = benchmark.start_server()
+        self.diffbot = DiffBot({'handler': 'memory'}, dev_token = 'test', attempts = 1)
+        self.diffbot.api_endpoint_base = 'http://%s:%d/api/' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def requests(self):
+        return sum(benchmark.StubRequestHandler.requests.values())
+
+    def test_warm(self):
+        from StringIO import StringIO
+        from warmer import CacheWarmer, load_manifest
+        manifest = load_manifest(StringIO('# manifest\n5 http://www.example.com/warm/c\n'
+                                          'http://www.example.com/warm/a\n'
+                                          '1 http://www.example.com/warm/b\n'
+                                          '9 http://www.example.com/fail/warm\n'))
+        self.diffbot.article('http://www.example.com/warm/b')
+        seen = []
+        warmer = CacheWarmer(self.diffbot, rate = 100, max_workers = 1,
+                             progress = lambda done, total, url, status: seen.append((url, status)))
+        warmer.start(manifest)
+        self.assertTrue(warmer.wait(10))
+        self.assertEqual([entry for entry in seen if entry[1] != 'skipped'],
+                         [('http://www.example.com/warm/a', 'fetched'),
+                          ('http://www.example.com/warm/c', 'fetched'),
+                          ('http://www.example.com/fail/warm', 'failed')])
+        self.assertTrue(('http://www.example.com/warm/b', 'skipped') in seen)
+        self.assertEqual(warmer.progress(), {'total': 4, 'done': 4, 'fetched': 2,
+                                             'skipped': 1, 'failed': 1})
+        requests = self.requests()
+        self.assertEqual(self.diffbot.article('http://www.example.com/warm/c')['title'], 'Example')
+        self.assertEqual(self.requests(), requests)
+
+    def test_rate_limited(self):
+        from warmer import CacheWarmer
+        urls = ['http://www.example.com/warm/rate/%d' % i for i in range(6)]
+        start = time.time()
+        CacheWarmer(self.diffbot, rate = 10, max_workers = 4).warm(urls)
+        self.assertTrue(time.time() - start >= 0.45)
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def fetch(self, url, data, parse = None, load = None):
+        self.calls.append(url)
+        if 'fail' in url:
+            return False
+        if parse is not None:
+            return parse('v%d' % len(self.calls))
+        return 'v%d' % len(self.calls)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_stale_served_while_refreshing(self):
+        cache = MemoryCacheHandler({'cache_soft_ttl': 0.1})
+        get = cache.wrap(self.fetch)
+        self.assertEqual(get('http://a', {}), 'v1')
+        self.assertEqual(get('http://a', {}), 'v1')
+        self.assertTrue(cache.fresh('http://a', {}))
+        time.sleep(0.15)
+        self.assertFalse(cache.fresh('http://a', {}))
+        self.assertEqual(cache.lookup('http://a', {}), None)
+        self.assertEqual(get('http://a', {}), 'v1')
+        self.wait_for(lambda: cache.stats().get('refreshed'))
+        self.assertEqual(get('http://a', {}), 'v2')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cache.stats()['stale'], 1)
+
+    def test_hard_ttl(self):
+        cache = FileCacheHandler({'cache_folder': self.folder, 'cache_soft_ttl': 0.05,
+                                  'cache_hard_ttl': 0.1})
+        get = cache.wrap(self.fetch)
+        self.assertEqual(get('http://a', {}), 'v1')
+        time.sleep(0.15)
+        self.assertEqual(get('http://a', {}), 'v2')
+
+    def test_parsed_entries(self):
+        cache = FileCacheHandler({'cache_folder': self.folder, 'cache_parsed': True,
+                                  'cache_soft_ttl': 0.1})
+        get = cache.wrap(self.fetch)
+        self.assertEqual(get('http://a', {}, parse = lambda v: {'v': v}), {'v': 'v1'})
+        self.assertEqual(get('http://a', {}, parse = lambda v: {'v': v}), {'v': 'v1'})
+        self.assertEqual(cache.lookup('http://a', {}, lambda v: {'v': v}), {'v': 'v1'})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_negative_caching(self):
+        cache = MemoryCacheHandler({'cache_negative_ttl': 0.2})
+        get = cache.wrap(self.fetch)
+        self.assertEqual(get('http://fail', {}), False)
+        self.assertEqual(get('http://fail', {}), False)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(cache.stats()['negative_hits'], 1)
+        time.sleep(0.25)
+        self.assertEqual(get('http://fail', {}), False)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(get('http://ok', {}), 'v3')
+
+    def test_client_negative_caching(self):
+        server = benchmark.start_server()
+        try:
+            db = DiffBot({'handler': 'memory', 'cache_negative_ttl': 60}, dev_token = 'test',
+                         attempts = 1)
+            db.api_endpoint_base = 'http://%s:%d/api/' % server.server_address
+            self.assertEqual(db.article('http://www.example.com/fail/negative'), False)
+            requests = sum(benchmark.StubRequestHandler.requests.values())
+            self.assertEqual(db.article('http://www.example.com/fail/negative'), False)
+            self.assertEqual(sum(benchmark.StubRequestHandler.requests.values()), requests)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class CanonicalKeyTest(unittest.TestCase):
+
+    endpoint = 'http://www.diffbot.com/api/article'
+
+    def setUp(self):
+        self.calls = []
+
+    def fetch(self, url, data, parse = None, load = None):
+        self.calls.append(data['url'])
+        return 'article %d' % len(self.calls)
+
+    def test_canonical_url(self):
+        self.assertEqual(cache.canonical_url('HTTP://Example.COM:80/a/b/?utm_source=x&b=2&a=1#top'),
+                         'http://example.com/a/b?a=1&b=2')
+        self.assertEqual(cache.canonical_url('https://example.com:443'), 'https://example.com/')
+        self.assertEqual(cache.canonical_url('https://example.com:8443//a/./c/../b/'),
+                         'https://example.com:8443/a/b')
+        self.assertEqual(cache.canonical_url('http://example.com/?fbclid=1&q='),
+                         'http://example.com/?q=')
+        self.assertEqual(cache.canonical_url('http://example.com/?ref=1', ['ref']),
+                         'http://example.com/')
+        self.assertEqual(cache.canonical_url('mailto:a@example.com'), 'mailto:a@example.com')
+        self.assertEqual(cache.canonical_url('http://example.com:bad/'), 'http://example.com:bad/')
+
+    def test_repeated_params_keep_their_order(self):
+        self.assertEqual(cache.canonical_url('http://example.com/?q=z&b=1&q=a'),
+                         'http://example.com/?b=1&q=z&q=a')
+        self.assertNotEqual(cache.canonical_url('http://example.com/?q=z&q=a'),
+                            cache.canonical_url('http://example.com/?q=a&q=z'))
+        handler = CacheHandler({})
+        self.assertNotEqual(handler.key(self.endpoint, [('url', 'a'), ('url', 'b')]),
+                            handler.key(self.endpoint, [('url', 'b'), ('url', 'a')]))
+
+    def test_hashbang_fragments_are_kept(self):
+        self.assertEqual(cache.canonical_url('http://Example.com/#!/story/1'),
+                         'http://example.com/#!/story/1')
+        self.assertNotEqual(cache.canonical_url('http://example.com/#!/story/1'),
+                            cache.canonical_url('http://example.com/#!/story/2'))
+        self.assertEqual(cache.canonical_url('http://example.com/#!/story/1?utm_source=x'),
+                         'http://example.com/#!/story/1?utm_source=x')
+        self.assertEqual(cache.canonical_url('http://example.com/story#comments'),
+                         'http://example.com/story')
+
+    def test_variants_share_an_entry(self):
+        files = MemoryCacheHandler({})
+        get = files.wrap(self.fetch)
+        variants = [
+            {'token': 'a', 'url': 'http://example.com/story'},
+            {'url': 'http://EXAMPLE.com/story/#comments', 'token': 'b'},
+            {'token': 'a', 'url': 'http://example.com:80/story?utm_campaign=feed'},
+        ]
+        for data in variants:
+            self.assertEqual(get(self.endpoint, data), 'article 1')
+        self.assertEqual(len(self.calls), 1)
+        self.assertNotEqual(files.key(self.endpoint, {'url': 'http://example.com/story'}),
+                            files.key(self.endpoint, {'url': 'http://example.com/other'}))
+        stats = files.stats()
+        self.assertEqual((stats['lookups'], stats['lookup_hits']), (3, 2))
+        self.assertAlmostEqual(stats['hit_ratio'], 2 / 3.0)
+
+    def test_options(self):
+        data = {'token': 'a', 'url': 'http://example.com/?ref=1'}
+        legacy = CacheHandler({'cache_canonical_keys': False})
+        self.assertEqual(legacy.canonical(self.endpoint, data),
+                         self.endpoint + '?' + urllib.urlencode(data))
+        custom = CacheHandler({'cache_strip_params': ['ref'], 'cache_key_exclude': []})
+        self.assertEqual(custom.canonical(self.endpoint, data),
+                         self.endpoint + '?token=a&url=http%3A%2F%2Fexample.com%2F')
+
+    def test_articles_count_each_lookup_once(self):
+        server = benchmark.start_server()
+        try:
+            db = DiffBot({'handler': 'memory'}, dev_token = 'test',
+                         http_options = {'handler': 'pool'})
+            db.api_endpoint_base = 'http://%s:%d/api/' % server.server_address
+            urls = ['http://example.com/counted/%d' % i for i in range(4)]
+            list(db.articles(urls))
+            list(db.articles(urls))
+            stats = db.http_handler().cache_handler().stats()
+            self.assertEqual((stats['lookups'], stats['lookup_hits']), (8, 4))
+            self.assertEqual(stats['hit_ratio'], 0.5)
+            db.http_handler().close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_key_report(self):
+        requests = [(self.endpoint, {'token': 't', 'url': url}) for url in
+                    ['http://a.com/x', 'http://a.com/x/', 'http://A.com/x?utm_source=y',
+                     'http://a.com/y']]
+        self.assertEqual(cache.key_report(requests), {'requests': 4, 'raw_keys': 4,
+                                                      'canonical_keys': 2,
+                                                      'duplicate_requests': 2})
+
+class ArticleTest(unittest.TestCase):
+
+    info = {'url': 'http://example.com/', 'title': u'Caf\xe9', 'text': u'Caf\xe9 text',
+            'html': u'<p>Caf\xe9</p>', 'tags': [], 'raw_response': '', 'extra': 1}
+
+    def test_dict_access(self):
+        article = Article(dict(self.info))
+        self.assertEqual(article['title'], u'Caf\xe9')
+        self.assertEqual(article.get('author', 'none'), 'none')
+        self.assertRaises(KeyError, lambda: article['author'])
+        self.assertTrue('extra' in article and article.has_key('tags'))
+        self.assertFalse('author' in article)
+        self.assertEqual(sorted(article.keys()), sorted(self.info.keys()))
+        self.assertEqual(dict(article), self.info)
+        self.assertEqual(article, self.info)
+        article['author'] = 'Someone'
+        del article['extra']
+        self.assertEqual(len(article), len(self.info))
+        self.assertFalse(hasattr(article, '__dict__'))
+
+    def test_lazy_decoding(self):
+        article = Article(dict(self.info))
+        self.assertEqual(article._text, 'Caf\xc3\xa9 text')
+        self.assertEqual(article['text'], u'Caf\xe9 text')
+        self.assertTrue(isinstance(article._text, unicode))
+        self.assertEqual(article['html'], u'<p>Caf\xe9</p>')
+
+    def test_pickle(self):
+        import cPickle
+
+        article = cPickle.loads(cPickle.dumps(Article(dict(self.info)), 2))
+        self.assertEqual(article._html, '<p>Caf\xc3\xa9</p>')
+        self.assertEqual(article, self.info)
+
+    def test_compact_articles(self):
+        server = benchmark.start_server()
+        try:
+            db = DiffBot(dev_token = 'test', http_options = {'handler': 'pool'},
+                         compact_articles = True)
+            db.api_endpoint_base = 'http://%s:%d/api/' % server.server_address
+            article = db.article('http://example.com/compact')
+            self.assertTrue(isinstance(article, Article))
+            self.assertEqual(article['title'], 'Example')
+            self.assertEqual(article['raw_response'], '')
+            url, article, error = list(db.articles(['http://example.com/compact']))[0]
+            self.assertTrue(isinstance(article, Article))
+            db.http_handler().close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_memory_benchmark(self):
+        result = benchmark.article_memory(count = 2000, size = 1000)
+        self.assertTrue(result['article_kb_per_100k'] < result['dict_kb_per_100k'])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
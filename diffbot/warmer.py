@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+"""
+    py-diffbot - warmer.py
+
+    Pre-populates the cache of a DiffBot client from a manifest of urls, so
+    the first requests after a deploy or a cache flush are hits
+
+    Usage:
+
+    >>> from diffbot.warmer import CacheWarmer, load_manifest
+    >>> warmer = CacheWarmer(db, rate = 5)
+    >>> warmer.start(load_manifest(open('manifest.txt')))
+    >>> warmer.progress()
+    {'total': 500, 'done': 120, 'fetched': 80, 'skipped': 38, 'failed': 2}
+
+    This source file is subject to the new BSD license that is bundled with this
+    package in the file LICENSE.txt. The license is also available online at the
+    URL: <http://nikcub.appspot.com/bsd-license.txt>
+
+    :copyright: Copyright (C) 2011 Nik Cubrilovic and others, see AUTHORS
+    :license: new BSD, see LICENSE for more details.
+"""
+
+__version__ = '0.0.2'
+__author__ = 'Nik Cubrilovic <nikcub@gmail.com>'
+
+import heapq, logging, threading
+
+from diffbot import DiffBotError, parse_article
+from handlers import RateLimiter
+import pool
+
+class CacheWarmer(object):
+    """Fetches the articles for a manifest of urls through a DiffBot client,
+    so they are stored in its cache handler under the keys real requests
+    use.
+
+    Urls are warmed in priority order, lowest number first. Urls whose
+    article is already cached (and fresh, for handlers with a ttl) are
+    skipped without a request. At most rate requests per second are made,
+    on max_workers threads. progress(done, total, url, status) is called
+    after each url, where status is 'fetched', 'skipped' or 'failed'.
+
+    format, comments and stats select the article requests to warm, as for
+    DiffBot.article.
+    """
+
+    def __init__(self, diffbot, rate = 2, max_workers = 2, progress = None,
+                 format = 'json', comments = False, stats = False):
+        self.diffbot = diffbot
+        self.max_workers = max_workers
+        self.callback = progress
+        self.request_options = (format, comments, stats)
+        # no burst, so a warm-up never sends a wave of requests at once
+        self._limiter = RateLimiter(rate, 1)
+        self._counts = {'total': 0, 'done': 0, 'fetched': 0, 'skipped': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def warm(self, manifest):
+        """Warms every url of manifest, an iterable of urls or of (priority,
+        url) pairs, and returns the progress counts"""
+        heap = []
+        for order, entry in enumerate(manifest):
+            if isinstance(entry, basestring):
+                entry = (0, entry)
+            priority, url = entry
+            heapq.heappush(heap, (priority, order, url))
+        self._update(total = len(heap))
+
+        def urls():
+            while heap and not self._stopped.isSet():
+                yield heapq.heappop(heap)[2]
+
+        for url, result, error in pool.imap(self._fetch, urls(), self.max_workers,
+                                            ordered = False, resolve = self._skip):
+            if error is not None:
+                logging.warning("cache warming failed for %s: %s" % (url, error))
+                status = 'failed'
+            else:
+                status = result
+            self._update(**{'done': 1, status: 1})
+            if self.callback is not None:
+                counts = self.progress()
+                self.callback(counts['done'], counts['total'], url, status)
+        return self.progress()
+
+    def start(self, manifest):
+        """Warms manifest on a background thread. Returns the thread."""
+        self._thread = threading.Thread(target = self.warm, args = (manifest,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def wait(self, timeout = None):
+        """Waits for a warm started with start to finish. Returns True if it
+        has."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+            return not self._thread.isAlive()
+        return True
+
+    def stop(self):
+        """Stops warming once the requests in progress complete"""
+        self._stopped.set()
+
+    def progress(self):
+        """Returns a dict of the total urls and how many are done, fetched,
+        skipped and failed"""
+        self._lock.acquire()
+        try:
+            return dict(self._counts)
+        finally:
+            self._lock.release()
+
+    def _update(self, **counts):
+        self._lock.acquire()
+        try:
+            for name, value in counts.items():
+                self._counts[name] += value
+        finally:
+            self._lock.release()
+
+    def _request(self, url):
+        return self.diffbot._article_request(url, *self.request_options)
+
+    def _skip(self, url):
+        api_endpoint, api_arguments = self._request(url)
+        cache = self.diffbot.http_handler().cache_handler()
+        if cache.fresh(api_endpoint, api_arguments, parse_article):
+            return 'skipped'
+        return None
+
+    def _fetch(self, url):
+        self._limiter.acquire()
+        api_endpoint, api_arguments = self._request(url)
+        if not self.diffbot._fetch_article(api_endpoint, api_arguments):
+            raise DiffBotError("Request failed for %s" % url)
+        return 'fetched'
+
+def load_manifest(fh):
+    """Yields (priority, url) pairs from a manifest with one url per line,
+    optionally preceded by a numeric priority ("10 http://..."). Blank lines
+    and lines starting with # are skipped; the default priority is 0."""
+    for line in fh:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            try:
+                yield float(parts[0]), parts[1].strip()
+                continue
+            except ValueError:
+                pass
+        yield 0, line